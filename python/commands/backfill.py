@@ -0,0 +1,65 @@
+import logging
+import asyncio
+from services.database import get_files_without_location, update_part_location
+from services.telegram import TelegramApi
+from services.tgclients import TGClients
+
+Log = logging.getLogger('BACKFILL')
+
+class Backfill():
+
+  batch = 50
+  timeout = 2
+
+  def __init__(self, batch = 50, timeout = 2):
+    self.batch = batch
+    self.timeout = timeout
+
+
+  async def backfill_command(self, Args):
+
+    dry_run = Args.backfill_dry_run is True
+
+    files = get_files_without_location()
+
+    Log.info(f"found {len(files)} files without document location")
+
+    client = TGClients.next_client()
+
+    total_updated_parts = 0
+    total_requests = 0
+
+    for file in files:
+      for part in file.parts:
+        if part.has_location():
+          continue
+
+        try:
+          message = await client.get_message(file.channel, part.messageid)
+          total_requests += 1
+
+          if message is None:
+            Log.warning(f"cannot get message from channel: {file.channel} -> {part.messageid} for '{file.filename}'")
+            continue
+
+          media = TelegramApi.get_media_from_message(message)
+          if media is None or str(part.fileid) != str(media.filedata.media_id):
+            Log.warning(f"file_id is different for '{file.filename}', channel: {file.channel}, message: {part.messageid}")
+            continue
+
+          if dry_run:
+            Log.info(f"'{file.filename}' [{part.index}] may be updated, skip as per dry_run")
+          else:
+            update_part_location(file.channel, part.messageid, media.filedata.access_hash, media.filedata.dc_id, media.filedata.file_reference)
+            total_updated_parts += 1
+            Log.debug(f"'{file.filename}' [{part.index}] location has been saved")
+
+        except Exception as e:
+          Log.error(f"file: '{file.filename}' got errors: {e}", exc_info=True)
+
+        if total_requests > 0 and total_requests % self.batch == 0:
+          Log.info(f"pause {self.timeout}s after {self.batch} requests")
+          await asyncio.sleep( self.timeout )
+          client = TGClients.next_client()
+
+    Log.info(f"Completed: {total_updated_parts} parts have been updated")
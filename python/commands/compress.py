@@ -0,0 +1,57 @@
+import logging
+from services.database import remap, get_files_with_content, update_file_content
+from services.hashing import get_content_hash
+from services.codec import ZSTD, compress_content, check_codec
+from configuration import Config
+
+Log = logging.getLogger('COMPRESS')
+
+class Compress():
+
+  async def compress_command(self, Args):
+
+    dry_run = Args.compress_dry_run is True
+
+    codec = Config.telegram.upload.compress
+    if codec == 'none':
+      Log.warning(f"`telegram.upload.compress` is none: new contents will be stored uncompressed")
+      codec = ZSTD
+    check_codec(codec)
+
+    total_files = 0
+    total_compressed = 0
+    total_skipped = 0
+    size_before = 0
+    size_after = 0
+
+    for record in get_files_with_content():
+      file = remap(record)
+      total_files += 1
+      size_before += len(file.content)
+
+      if file.content_codec is not None:
+        # already compressed
+        size_after += len(file.content)
+        continue
+
+      content, content_codec = compress_content(file.content, codec)
+      size_after += len(content)
+
+      if content_codec is None:
+        Log.debug(f"'{file.filename}' [{file.id}] does not get smaller, skip")
+        total_skipped += 1
+        continue
+
+      if dry_run:
+        Log.info(f"'{file.filename}' [{file.id}] may be compressed: {len(file.content)} -> {len(content)} bytes, skip as per dry_run")
+      else:
+        update_file_content(file.id, content, content_codec, len(file.content), file.hash or get_content_hash(file.content))
+        Log.debug(f"'{file.filename}' [{file.id}] has been compressed: {len(file.content)} -> {len(content)} bytes")
+
+      total_compressed += 1
+
+    saved = size_before - size_after
+    ratio = (saved * 100 / size_before) if size_before > 0 else 0
+
+    Log.info(f"Completed: {total_compressed} of {total_files} files {'may be' if dry_run else 'have been'} compressed, {total_skipped} do not get smaller")
+    Log.info(f"DB contents: {size_before} -> {size_after} bytes, saved {saved} bytes ({ratio:.1f}%)")
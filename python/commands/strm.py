@@ -110,7 +110,7 @@ class Strm():
       if type(file.content) is not bytes:
         content_as_byte = base64.b64decode(file.content)
       else:
-        content_as_byte = file.content
+        content_as_byte = file.get_content()
 
       recreate = self.check_file_recreation(destination_full_path, content_as_byte)
 
@@ -1,7 +1,10 @@
+import asyncio
 import os
 import traceback
 import logging
 from services.database import getItem, TGFolder
+from services.hashing import get_file_hash
+from configuration import Config
 from constants import ROOT_ID
 from services.fsapi import FSApi as FSApiLib
 
@@ -130,13 +133,41 @@ class Sync():
   
   async def proceed_to_sync(self, file_list, delete_original= False):
 
+    # small files are synced at the same time, as many as fit a shared document
+    packed = []
+    packed_size = 0
+
     for file in file_list:
+      try:
+        size = os.path.getsize(file[0])
+      except OSError:
+        size = None
+
+      if size is not None and Config.telegram.upload.min_size < size <= Config.telegram.upload.pack.size:
+        packed.append(file)
+        packed_size += size
+        if packed_size >= Config.telegram.upload.pack.container:
+          await self.sync_files(packed, delete_original= delete_original)
+          packed = []
+          packed_size = 0
+        continue
+
+      await self.sync_files([ file ], delete_original= delete_original)
+
+    await self.sync_files(packed, delete_original= delete_original)
+
+
+  async def sync_files(self, file_list, delete_original= False):
+
+    async def task(file):
       try:
         await internal_task(file, delete_original= delete_original)
       except Exception as e:
         traceback.print_exc()
         Log.error(e, exc_info=True)
 
+    await asyncio.gather(*[ task(file) for file in file_list ])
+
 
 async def internal_task(item, delete_original= False):
   destination_file_path = item[1]
@@ -147,9 +178,22 @@ async def internal_task(item, delete_original= False):
 
   
   fsapi.create_folder_recursive(destination_file_path, skip_last = True)
-  
+
+  hash = None
   try:
-    service = await fsapi.create_file_with_content(destination_file_path, stop_if_exists= True)
+    duplicate = None
+    if Config.telegram.upload.dedup:
+      # same content already on telegram: its parts are reused
+      hash = await asyncio.to_thread(get_file_hash, filename_full_path)
+      duplicate = await fsapi.create_file_from_duplicate(destination_file_path, os.path.getsize(filename_full_path), hash, stop_if_exists= True)
+
+    if duplicate is None:
+      service = await fsapi.create_file_with_content(destination_file_path, stop_if_exists= True)
+      if service:
+        # the file is not hashed again while it is uploaded
+        service.source_hash = hash
+    else:
+      service = None
   except Exception as E:
     Log.error(E)
     Log.warning(f"'{destination_file_path}' cannot be synced due to: {E}")
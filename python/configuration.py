@@ -36,15 +36,58 @@ def load_config(args):
       "users": getYamlValue(yamlFile, ['telegram', 'users']),
       "upload": {
         "min_size": uploadMinSize,
-        "channel": getYamlValue(yamlFile, ['telegram', 'upload', 'channel'] )
+        "channel": getYamlValue(yamlFile, ['telegram', 'upload', 'channel'] ),
+        "parallel": max( int( getYamlValue(yamlFile, ['telegram', 'upload', 'parallel'], 4) ), 1 ),
+        "stripe": max( int( getYamlValue(yamlFile, ['telegram', 'upload', 'stripe'], 1) ), 1 ),
+        "resume_ttl": int( getYamlValue(yamlFile, ['telegram', 'upload', 'resume_ttl'], 3600) ),
+        "dedup": getYamlValue(yamlFile, ['telegram', 'upload', 'dedup'], True) is not False,
+        "compress": str( getYamlValue(yamlFile, ['telegram', 'upload', 'compress']) or 'none' ).lower(),
+        "compress_level": int( getYamlValue(yamlFile, ['telegram', 'upload', 'compress_level'], 3) ),
+        "pack": {
+          "size": int( getYamlValue(yamlFile, ['telegram', 'upload', 'pack', 'size'], 0) ),
+          "container": int( getYamlValue(yamlFile, ['telegram', 'upload', 'pack', 'container'], 64 * 1024 * 1024) ),
+          "linger": float( getYamlValue(yamlFile, ['telegram', 'upload', 'pack', 'linger'], 2) )
+        }
       },
       "notify": {
         "channel": getYamlValue(yamlFile, ['telegram', 'upload', 'channel'] )
       },
+      "download": {
+        "prefetch": max( int( getYamlValue(yamlFile, ['telegram', 'download', 'prefetch'], 4) ), 1 ),
+        "location_ttl": int( getYamlValue(yamlFile, ['telegram', 'download', 'location_ttl'], 3600) ),
+        "precise": getYamlValue(yamlFile, ['telegram', 'download', 'precise'], True) is not False,
+        "stripe": max( int( getYamlValue(yamlFile, ['telegram', 'download', 'stripe'], 1) ), 1 ),
+        "retries": max( int( getYamlValue(yamlFile, ['telegram', 'download', 'retries'], 5) ), 0 ),
+        "sessions": max( int( getYamlValue(yamlFile, ['telegram', 'download', 'sessions'], 2) ), 1 ),
+        "warmup": getYamlValue(yamlFile, ['telegram', 'download', 'warmup'], True) is not False,
+        "stream_buffer": int( getYamlValue(yamlFile, ['telegram', 'download', 'stream_buffer'], 16 * 1024 * 1024) ),
+        "memory": int( getYamlValue(yamlFile, ['telegram', 'download', 'memory'], 512 * 1024 * 1024) )
+      },
       "bot_token": getYamlValue(yamlFile, ['telegram','bot_token'])
     },
     "data": os.path.realpath( os.path.join( CWD, args.data or getYamlValue(yamlFile, ['data']) or './data/' ) ),
     
+    "cache": {
+      "disk": {
+        "size": int( getYamlValue(yamlFile, ['cache', 'disk', 'size'], 0) ),
+        "folder": getYamlValue(yamlFile, ['cache', 'disk', 'folder']) or 'cache'
+      },
+      "memory": {
+        "size": int( getYamlValue(yamlFile, ['cache', 'memory', 'size'], 64 * 1024 * 1024) ),
+        "head": int( getYamlValue(yamlFile, ['cache', 'memory', 'head'], 4 * 1024 * 1024) ),
+        "tail": int( getYamlValue(yamlFile, ['cache', 'memory', 'tail'], 4 * 1024 * 1024) )
+      },
+      "readahead": {
+        "size": int( getYamlValue(yamlFile, ['cache', 'readahead', 'size'], 8 * 1024 * 1024) ),
+        "idle": int( getYamlValue(yamlFile, ['cache', 'readahead', 'idle'], 60) )
+      },
+      "pin": {
+        "size": int( getYamlValue(yamlFile, ['cache', 'pin', 'size'], 0) ),
+        "folder": getYamlValue(yamlFile, ['cache', 'pin', 'folder']) or 'pins',
+        "hits": int( getYamlValue(yamlFile, ['cache', 'pin', 'hits'], 0) )
+      }
+    },
+
     "db": get_env('DB') or args.database or getYamlValue(yamlFile, ['db']),
     
     "logger": args.log or getYamlValue(yamlFile, ['logger']) or 'info',
@@ -71,7 +114,9 @@ def load_config(args):
   Config = SimpleNamespace(**__Config)
   Config.telegram = SimpleNamespace(**Config.telegram)
   Config.telegram.upload = SimpleNamespace(**Config.telegram.upload)
+  Config.telegram.upload.pack = SimpleNamespace(**Config.telegram.upload.pack)
   Config.telegram.notify = SimpleNamespace(**Config.telegram.notify)
+  Config.telegram.download = SimpleNamespace(**Config.telegram.download)
 
   users = []
   for user in Config.telegram.users:
@@ -79,6 +124,12 @@ def load_config(args):
   
   Config.telegram.users = users
 
+  Config.cache = SimpleNamespace( **Config.cache )
+  Config.cache.disk = SimpleNamespace( **Config.cache.disk )
+  Config.cache.memory = SimpleNamespace( **Config.cache.memory )
+  Config.cache.readahead = SimpleNamespace( **Config.cache.readahead )
+  Config.cache.pin = SimpleNamespace( **Config.cache.pin )
+
   Config.http = SimpleNamespace( **Config.http )
 
   Config.strm = SimpleNamespace( **Config.strm )
\ No newline at end of file
@@ -0,0 +1,152 @@
+from aiohttp import web
+from email.utils import formatdate, parsedate_to_datetime
+from services.database import TGFile
+import datetime
+import uuid
+
+# more ranges than this are merged together, in order to avoid tiny parts of a multipart response
+MAX_RANGES = 16
+
+
+def parse_range_header(header: str, size: int):
+  """
+  parses a `Range` header (RFC 7233), returning the list of (start, end) satisfiable ranges,
+  with `end` included. Returns None when the header is not valid and must be ignored
+  """
+  unit, _, specs = header.partition('=')
+  if unit.strip().lower() != 'bytes' or not specs.strip():
+    return None
+
+  ranges = []
+  for spec in specs.split(','):
+    spec = spec.strip()
+    if not spec:
+      continue
+
+    first, sep, last = spec.partition('-')
+    first = first.strip()
+    last = last.strip()
+    if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+      return None
+
+    if not first:
+      # suffix range: last N bytes
+      if not last:
+        return None
+      length = int(last)
+      if length == 0:
+        continue
+      ranges.append( (max(size - length, 0), size - 1) )
+      continue
+
+    start = int(first)
+    if last and int(last) < start:
+      return None
+    if start >= size:
+      continue
+    end = min(int(last), size - 1) if last else size - 1
+    ranges.append( (start, end) )
+
+  if len(ranges) > MAX_RANGES:
+    ranges = merge_ranges(ranges)
+
+  return ranges
+
+
+def merge_ranges(ranges: list[tuple[int, int]]):
+  merged = []
+  for start, end in sorted(ranges):
+    if len(merged) > 0 and start <= merged[-1][1] + 1:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+    else:
+      merged.append( (start, end) )
+  return merged
+
+
+def get_etag(item: TGFile):
+  # strong validator: renaming or moving the entry keeps it
+  return f"\"{item.content_tag()}\""
+
+
+def get_last_modified(item: TGFile):
+  return formatdate( item.mtime.timestamp(), usegmt= True )
+
+
+def parse_http_date(value: str):
+  try:
+    date = parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  if date.tzinfo is None:
+    date = date.replace(tzinfo= datetime.UTC)
+  return date
+
+
+def match_etag(header: str, etag: str, weak: bool):
+  for candidate in header.split(','):
+    candidate = candidate.strip()
+    if candidate == '*':
+      return True
+    if weak and candidate.startswith('W/'):
+      candidate = candidate[2:]
+    if candidate == etag:
+      return True
+  return False
+
+
+def is_not_modified(request: web.Request, item: TGFile, etag: str):
+  """
+  evaluates `If-None-Match` and, when missing, `If-Modified-Since`
+  """
+  if_none_match = request.headers.get('If-None-Match')
+  if if_none_match is not None:
+    return match_etag(if_none_match, etag, weak= True)
+
+  if_modified_since = request.headers.get('If-Modified-Since')
+  if if_modified_since is not None:
+    date = parse_http_date(if_modified_since)
+    # HTTP dates have a resolution of one second
+    return date is not None and int(item.mtime.timestamp()) <= date.timestamp()
+
+  return False
+
+
+def is_range_valid(request: web.Request, item: TGFile, etag: str):
+  """
+  evaluates `If-Range`: when it does not match, the entire content is sent
+  """
+  if_range = request.headers.get('If-Range')
+  if if_range is None:
+    return True
+
+  if_range = if_range.strip()
+  if if_range.startswith('"') or if_range.startswith('W/'):
+    # weak validators cannot be used with If-Range
+    return if_range == etag
+
+  date = parse_http_date(if_range)
+  return date is not None and int(item.mtime.timestamp()) == date.timestamp()
+
+
+def get_multipart_boundary():
+  return uuid.uuid4().hex
+
+
+def get_part_header(boundary: str, content_type: str, start: int, end: int, size: int):
+  return (
+    f"\r\n--{boundary}\r\n"
+    f"Content-Type: {content_type}\r\n"
+    f"Content-Range: bytes {start}-{end}/{size}\r\n"
+    "\r\n"
+  ).encode()
+
+
+def get_multipart_end(boundary: str):
+  return f"\r\n--{boundary}--\r\n".encode()
+
+
+def get_multipart_length(boundary: str, content_type: str, ranges: list[tuple[int, int]], size: int):
+  length = len( get_multipart_end(boundary) )
+  for start, end in ranges:
+    length += len( get_part_header(boundary, content_type, start, end, size) ) + (end - start) + 1
+  return length
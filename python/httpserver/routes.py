@@ -1,9 +1,12 @@
 import os
 from aiohttp import web
 import mimetypes
-from services.database import TGFile, TGFolder, start_session, getItem, getItemByFilename, update_file, removeItem, update_folder
+from services.database import TGFile, TGFolder, start_session, getItem, getItemByFilename, update_file, removeItem, update_folder, get_file_without_content
 from constants import ROOT_ID
 from services.fsapi import FSApi as FSApiLib
+from services import playback, pins
+from services.uploader import StreamSource
+from . import ranges
 from configuration import CWD
 import logging
 
@@ -108,19 +111,16 @@ async def create_folder(request: web.Request):
 
 
 
-@routes.get(r"/files/{file_id}")
-async def download_file(request: web.Request):
-
-  Log.info('Got download request')
-  file_id = request.match_info["file_id"]
-
-  Log.info(f"file requested is: {file_id}")
-
-  dbFile = getItem(file_id, state= None)
+def get_download_item(file_id):
+  """
+  returns (item, size, None) for a file which can be downloaded, (None, 0, error response) otherwise
+  """
+  # DB content is loaded only when it is going to be streamed
+  dbFile = get_file_without_content(file_id, state= None)
 
   if dbFile is None:
     Log.info(f"invalid ID {file_id}: not exists")
-    return web.Response(
+    return None, 0, web.Response(
       status=404,
       body=f"invalid ID '{file_id}': not exists"
     )
@@ -128,7 +128,7 @@ async def download_file(request: web.Request):
 
   if dbFile.state != 'ACTIVE':
     Log.info(f"item '{file_id}': is not available")
-    return web.Response(
+    return None, 0, web.Response(
       status=422,
       body=f"item '{file_id}': is not available"
     )
@@ -136,70 +136,159 @@ async def download_file(request: web.Request):
 
   if dbFile.type == 'folder':
     Log.error(f"requested item is a folder [{dbFile.id}] '{dbFile.filename}")
-    return web.Response(
+    return None, 0, web.Response(
       status=422,
       body=f"requested item is a folder [{dbFile.id}] '{dbFile.filename}"
     )
-  
-  # parse Range header
 
   totalsize = 0
 
-  if dbFile.content is not None:
-    totalsize = len( dbFile.content )
-  elif dbFile.parts:
+  if dbFile.parts:
     for part in dbFile.parts:
       totalsize += part.size
+  elif dbFile.content_length() > 0:
+    totalsize = dbFile.content_length()
   else:
     Log.error(f"cannot serve file caused by no content nor parts: {dbFile.toDB()}")
-    return web.Response(
+    return None, 0, web.Response(
       status=422,
       body=f"file is not a valid file"
     )
 
-  totalsize = int(totalsize)
+  return dbFile, int(totalsize), None
 
-  range_header = request.headers.get("Range", 0)
 
-  if range_header:
-    start, end = range_header.replace("bytes=", "").split("-")
-    start = int(start)
-    end = int(end) if end else totalsize - 1
-  else:
-    start = request.http_range.start or 0
-    end = (request.http_range.stop or totalsize) - 1
-  
-  path = FSApiLib.build_path(dbFile)
-
-  stream = web.StreamResponse(
-    status=206 if range_header else 200,
-    headers={
-      "Content-Type": f"{dbFile.type}",
-      "Content-Range": f"bytes {start}-{end}/{totalsize}",
-      "Content-Length": str((end - start) + 1),
-      "Content-Disposition": f"inline; filename=\"{dbFile.filename}\"",
-      "Accept-Ranges": "bytes",
-    },
-  )
+def get_download_response(request: web.Request, dbFile: TGFile, totalsize: int):
+  """
+  evaluates conditional and range headers, returning (response, ranges, boundary):
+  `ranges` is None when the response has no body
+  """
+  etag = ranges.get_etag(dbFile)
+
+  headers = {
+    "ETag": etag,
+    "Last-Modified": ranges.get_last_modified(dbFile),
+    "Accept-Ranges": "bytes",
+  }
+
+  if ranges.is_not_modified(request, dbFile, etag):
+    Log.info(f"'{dbFile.filename}' is not modified")
+    return web.Response(status=304, headers=headers), None, None
+
+  headers["Content-Disposition"] = f"inline; filename=\"{dbFile.filename}\""
+
+  selected = None
+  range_header = request.headers.get("Range")
+  if range_header and ranges.is_range_valid(request, dbFile, etag):
+    selected = ranges.parse_range_header(range_header, totalsize)
+
+  if selected is not None and len(selected) == 0:
+    Log.info(f"range not satisfiable: {range_header}, size: {totalsize}")
+    headers["Content-Range"] = f"bytes */{totalsize}"
+    return web.Response(status=416, headers=headers), None, None
+
+  if selected is None:
+    headers["Content-Type"] = f"{dbFile.type}"
+    headers["Content-Length"] = str(totalsize)
+    return web.StreamResponse(status=200, headers=headers), [ (0, totalsize - 1) ], None
+
+  if len(selected) == 1:
+    start, end = selected[0]
+    headers["Content-Type"] = f"{dbFile.type}"
+    headers["Content-Length"] = str((end - start) + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{totalsize}"
+    return web.StreamResponse(status=206, headers=headers), selected, None
+
+  boundary = ranges.get_multipart_boundary()
+  headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+  headers["Content-Length"] = str( ranges.get_multipart_length(boundary, dbFile.type, selected, totalsize) )
+  return web.StreamResponse(status=206, headers=headers), selected, boundary
+
+
+@routes.head(r"/files/{file_id}")
+async def download_file_head(request: web.Request):
+  file_id = request.match_info["file_id"]
+
+  Log.info(f"file info requested: {file_id}")
+
+  dbFile, totalsize, error = get_download_item(file_id)
+  if error is not None:
+    return error
+
+  # same headers of GET, without touching telegram
+  response, _, _ = get_download_response(request, dbFile, totalsize)
+  if isinstance(response, web.Response):
+    return response
+
+  await response.prepare(request)
+  await response.write_eof()
+  return response
+
+
+@routes.get(r"/files/{file_id}", allow_head=False)
+async def download_file(request: web.Request):
+
+  Log.info('Got download request')
+  file_id = request.match_info["file_id"]
+
+  Log.info(f"file requested is: {file_id}")
+
+  dbFile, totalsize, error = get_download_item(file_id)
+  if error is not None:
+    return error
+
+  stream, selected, boundary = get_download_response(request, dbFile, totalsize)
+  if selected is None:
+    return stream
+
+  pinned = None
+  if pins.PinnedFiles is not None:
+    pinned = pins.PinnedFiles.get_pinned_path(dbFile)
+    if selected[0][0] == 0:
+      # count plays, not every range requested while playing
+      pins.PinnedFiles.on_access(dbFile, totalsize)
 
   await stream.prepare(request)
 
-  service = await FSApi.read_file_content(path, start, end)
+  service = None
+  try:
 
-  if service:
-    try:
+    for start, end in selected:
+      if boundary is not None:
+        await stream.write( ranges.get_part_header(boundary, dbFile.type, start, end, totalsize) )
 
-      await service.execute( stream, True )
-      return
-  
-    except ConnectionResetError:
+      if pinned is not None:
+        await pins.send_file_range(request, stream, pinned, start, end)
+        continue
+
+      service = await FSApi.read_item_content(dbFile, start, end)
+
+      if len(selected) == 1:
+        playback.on_range_request( (request.remote, request.headers.get("User-Agent"), dbFile.id), service )
+
+      await service.execute( stream, True, eof= boundary is None )
+
+      if service.aborted:
+        return stream
+
+    if boundary is not None:
+      await stream.write( ranges.get_multipart_end(boundary) )
+    if boundary is not None or pinned is not None:
+      await stream.write_eof()
+
+    if pinned is not None:
+      Log.info(f"served pinned file '{dbFile.filename}'")
+
+    return stream
+
+  except ConnectionResetError:
+    if service is not None:
       service.stop()
-      Log.warning("connection aborted")
-      return
+    Log.warning("connection aborted")
+    return stream
 
-    except Exception as E:
-      Log.error(E)
-    
+  except Exception as E:
+    Log.error(E)
   
   try:
     # close connection
@@ -207,6 +296,73 @@ async def download_file(request: web.Request):
   except Exception:
     Log.warning(f"cannot write_eof")
 
+  return stream
+
+
+@routes.put(r"/files/{file_id}/pin")
+async def pin_file(request: web.Request):
+  file_id = request.match_info["file_id"]
+
+  if pins.PinnedFiles is None:
+    return web.Response(
+      status=422,
+      body=f"file pinning is disabled"
+    )
+
+  dbFile, totalsize, error = get_download_item(file_id)
+  if error is not None:
+    return error
+
+  if not dbFile.parts:
+    return web.Response(
+      status=422,
+      body=f"file '{dbFile.filename}' is stored in DB"
+    )
+
+  try:
+    pins.PinnedFiles.pin(dbFile, totalsize)
+  except Exception as e:
+    Log.error(e)
+    return web.Response(
+      status=422,
+      body=f"{e}"
+    )
+
+  Log.info(f"pin requested for '{dbFile.filename}' [{dbFile.id}]")
+
+  return web.Response(
+    status=202,
+    body=f"file pinned: {dbFile.id}"
+  )
+
+
+@routes.delete(r"/files/{file_id}/pin")
+async def unpin_file(request: web.Request):
+  file_id = request.match_info["file_id"]
+
+  if pins.PinnedFiles is None:
+    return web.Response(
+      status=422,
+      body=f"file pinning is disabled"
+    )
+
+  pins.PinnedFiles.unpin(file_id)
+
+  Log.info(f"unpinned file {file_id}")
+
+  return web.Response(
+    status=200,
+    body=f"file unpinned: {file_id}"
+  )
+
+
+@routes.get(r"/pins")
+async def list_pins(request: web.Request):
+  if pins.PinnedFiles is None:
+    return web.json_response( [] )
+
+  return web.json_response( pins.PinnedFiles.get_pinned_files() )
+
 
 @routes.post(r"/folders/{fldid}/files/{filename}")
 @routes.post(r"/folders/{fldid}/files/")
@@ -214,10 +370,15 @@ async def download_file(request: web.Request):
 async def upload_file(request: web.Request):
   fldid = request.match_info['fldid']
 
-  post = await request.post()
-  for key, item in post.items():
-    is_file = getattr(item, 'filename', False)
-    if is_file is not False:
+  # parts are read while they are received, without spooling the body
+  reader = await request.multipart()
+  while True:
+    item = await reader.next()
+    if item is None:
+      break
+
+    is_file = getattr(item, 'filename', None)
+    if is_file is not None:
       # found file part to upload
       filename = None
       if 'filename' in request.match_info:
@@ -248,7 +409,7 @@ async def upload_file(request: web.Request):
 
       if service:
         try:
-          await service.execute(item.file)
+          await service.execute( StreamSource(item) )
       
           return web.Response(
             status=201,
@@ -256,7 +417,7 @@ async def upload_file(request: web.Request):
           )
       
         except ConnectionResetError:
-          service.stop()
+          await service.stop()
           Log.warning("connection aborted")
           return
 
@@ -399,6 +560,8 @@ async def merge_file(request: web.Request):
         body=f"Part not exists in db '{part_id}'"
       )
     dbFile.parts = dbFile.parts + dbPart.parts
+    # digest of the merged content is not known
+    dbFile.hash = None
 
     update_file(dbFile, dbFile)
 
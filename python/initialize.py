@@ -184,6 +184,28 @@ parser.add_argument('--copy_dry_run',
                     help='simulate copy files'
                     )
 
+parser.add_argument('--backfill',
+                    type = bool,
+                    help='save telegram document location of files uploaded by older versions',
+                    action=argparse.BooleanOptionalAction
+                    )
+parser.add_argument('--backfill_dry_run',
+                    type = bool,
+                    action=argparse.BooleanOptionalAction,
+                    help='simulate backfill'
+                    )
+
+parser.add_argument('--compress',
+                    type = bool,
+                    help='compress file contents stored in database with zstd, reporting the space saved',
+                    action=argparse.BooleanOptionalAction
+                    )
+parser.add_argument('--compress_dry_run',
+                    type = bool,
+                    action=argparse.BooleanOptionalAction,
+                    help='simulate compress'
+                    )
+
 Args = parser.parse_args()
 
 if not os.path.exists(Args.config) :
@@ -0,0 +1,218 @@
+from configuration import Config
+from collections import OrderedDict
+import asyncio
+import os
+import logging
+
+Log = logging.getLogger('ChunkCache')
+
+
+class DiskChunkCache():
+
+  folder = None
+  max_size = 0
+  current_size = 0
+
+  # (media_id, offset) -> size, least recently used first
+  entries = None
+
+  # (media_id, offset) -> bytes of chunks being written to disk
+  pending = None
+
+  def __init__(self, folder: str, max_size: int):
+    self.folder = folder
+    self.max_size = max_size
+    self.current_size = 0
+    self.entries = OrderedDict()
+    self.pending = {}
+    self.writing = set()
+
+
+  def load(self):
+    if not os.path.exists(self.folder):
+      os.makedirs(self.folder)
+
+    found = []
+    for media_folder in os.scandir(self.folder):
+      if not media_folder.is_dir():
+        continue
+      for chunk in os.scandir(media_folder.path):
+        if not chunk.name.endswith('.chunk'):
+          # leftover of an interrupted write
+          os.remove(chunk.path)
+          continue
+        stat = chunk.stat()
+        found.append( (stat.st_mtime, (int(media_folder.name), int(chunk.name[0 : -6])), stat.st_size) )
+
+    # oldest first, so the LRU order survives restarts
+    found.sort(key= lambda item: item[0])
+    for _, key, size in found:
+      self.entries[key] = size
+      self.current_size += size
+
+    Log.info(f"chunk cache in '{self.folder}': {len(self.entries)} chunks, {self.current_size} of {self.max_size} bytes")
+    self.evict()
+
+
+  def get_path(self, media_id, offset):
+    return os.path.join(self.folder, str(media_id), f"{offset}.chunk")
+
+
+  def _read(self, path):
+    with open(path, 'rb') as f:
+      data = f.read()
+    # refresh mtime in order to keep LRU order after restart
+    os.utime(path)
+    return data
+
+  def _write(self, path, data):
+    os.makedirs(os.path.dirname(path), exist_ok= True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+      f.write(data)
+    os.replace(temp_path, path)
+
+  def _remove(self, path):
+    try:
+      os.remove(path)
+      os.rmdir(os.path.dirname(path))
+    except OSError:
+      # folder is not empty or file is already gone
+      pass
+
+
+  async def get(self, media_id, offset):
+    key = (int(media_id), int(offset))
+    if key not in self.entries:
+      return None
+
+    self.entries.move_to_end(key)
+
+    if key in self.pending:
+      return self.pending[key]
+
+    try:
+      return await asyncio.to_thread(self._read, self.get_path(*key))
+    except OSError as e:
+      Log.warning(f"cannot read chunk {key} from cache: {e}")
+      self.discard(key)
+      return None
+
+
+  def put(self, media_id, offset, data: bytes):
+    key = (int(media_id), int(offset))
+    if key in self.entries or key in self.pending or len(data) == 0 or len(data) > self.max_size:
+      return
+
+    self.entries[key] = len(data)
+    self.current_size += len(data)
+    self.pending[key] = data
+
+    # write in background: the stream does not wait for the disk
+    task = asyncio.ensure_future( self.store(key, data) )
+    self.writing.add(task)
+    task.add_done_callback(self.writing.discard)
+
+    self.evict()
+
+  async def store(self, key, data):
+    path = self.get_path(*key)
+    try:
+      await asyncio.to_thread(self._write, path, data)
+    except OSError as e:
+      Log.warning(f"cannot write chunk {key} into cache: {e}")
+      self.discard(key)
+      return
+    finally:
+      del self.pending[key]
+
+    if key not in self.entries:
+      # evicted while it was being written
+      await asyncio.to_thread(self._remove, path)
+
+
+  def discard(self, key):
+    size = self.entries.pop(key, None)
+    if size is not None:
+      self.current_size -= size
+
+
+  def evict(self):
+    while self.current_size > self.max_size and len(self.entries) > 0:
+      key, size = self.entries.popitem(last= False)
+      self.current_size -= size
+      Log.debug(f"evict chunk {key} from cache")
+      if key not in self.pending:
+        # otherwise it is removed once written
+        asyncio.get_event_loop().run_in_executor(None, self._remove, self.get_path(*key))
+
+
+class MemoryChunkCache():
+
+  max_size = 0
+  current_size = 0
+  head = 0
+  tail = 0
+
+  # (media_id, offset) -> bytes, least recently used first
+  # DB content is stored as (item id, mtime) -> bytes
+  entries = None
+
+  def __init__(self, max_size: int, head: int, tail: int):
+    self.max_size = max_size
+    self.head = head
+    self.tail = tail
+    self.current_size = 0
+    self.entries = OrderedDict()
+
+
+  def is_hot_region(self, offset, limit, size):
+    # players and scanners probe the beginning and the end of each file
+    return offset < self.head or (offset + limit) > (size - self.tail)
+
+
+  def get(self, media_id, offset):
+    key = (media_id, offset)
+    data = self.entries.get(key, None)
+    if data is not None:
+      self.entries.move_to_end(key)
+    return data
+
+
+  def put(self, media_id, offset, data: bytes):
+    key = (media_id, offset)
+    if key in self.entries or len(data) == 0 or len(data) > self.max_size:
+      return
+
+    self.entries[key] = data
+    self.current_size += len(data)
+
+    while self.current_size > self.max_size:
+      _, evicted = self.entries.popitem(last= False)
+      self.current_size -= len(evicted)
+
+
+DiskCache: DiskChunkCache | None = None
+MemoryCache: MemoryChunkCache | None = None
+
+def init_chunk_cache():
+  global DiskCache, MemoryCache
+
+  if Config.cache.memory.size > 0:
+    MemoryCache = MemoryChunkCache(
+      Config.cache.memory.size,
+      Config.cache.memory.head,
+      Config.cache.memory.tail
+    )
+    Log.info(f"memory cache: {Config.cache.memory.size} bytes for first {Config.cache.memory.head} and last {Config.cache.memory.tail} bytes of files")
+  else:
+    Log.info('memory cache is disabled')
+
+  if Config.cache.disk.size > 0:
+    DiskCache = DiskChunkCache(
+      os.path.join(Config.data, Config.cache.disk.folder),
+      Config.cache.disk.size
+    )
+    DiskCache.load()
+  else:
+    Log.info('disk cache is disabled')
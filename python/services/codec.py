@@ -0,0 +1,51 @@
+from configuration import Config
+import logging
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+Log = logging.getLogger('Codec')
+
+ZSTD = 'zstd'
+
+
+def check_codec(codec: str):
+  if codec != ZSTD:
+    raise Exception(f"unknown codec '{codec}' of file content")
+  if zstandard is None:
+    raise Exception(f"`zstandard` package is required by '{codec}' codec")
+
+
+def compress_content(content: bytes, codec: str | None = None):
+  """
+  returns the content to be stored in DB and its codec, None when it is stored as it is:
+  contents which do not get smaller are not compressed
+  """
+  codec = codec or Config.telegram.upload.compress
+  if codec == 'none' or len(content) == 0:
+    return content, None
+
+  check_codec(codec)
+  compressed = zstandard.ZstdCompressor( level= Config.telegram.upload.compress_level ).compress(content)
+  if len(compressed) >= len(content):
+    return content, None
+
+  return compressed, codec
+
+
+def decompress_content(content: bytes, codec: str | None):
+  if codec is None:
+    return content
+
+  check_codec(codec)
+  return zstandard.ZstdDecompressor().decompress(content)
+
+
+def iter_content(content: bytes, codec: str, size: int):
+  """
+  returns an iterator of the decompressed content, by blocks of `size` bytes
+  """
+  check_codec(codec)
+  return zstandard.ZstdDecompressor().read_to_iter(content, write_size= size)
@@ -174,8 +174,12 @@ class CopyBatch():
             hash= part.hash,
             fileid= newmedia.filedata.media_id,
             originalfilename = part.originalfilename,
-            size= newmedia.file_size,
-            index= part.index
+            size= part.size,
+            index= part.index,
+            access_hash= newmedia.filedata.access_hash,
+            dc_id= newmedia.filedata.dc_id,
+            file_reference= newmedia.filedata.file_reference,
+            offset= part.offset
           )
           # for attr in newmedia.document.attributes:
           #   if attr.QUALNAME == 'types.DocumentAttributeFilename':
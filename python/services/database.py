@@ -1,13 +1,16 @@
-from pymongo import MongoClient, TEXT
+from pymongo import MongoClient, TEXT, ReturnDocument
 import datetime
 import traceback
 from configuration import Config
 from urllib.parse import urlparse
 from constants import ROOT_ID, ROOT_NAME
+from services.hashing import get_content_hash
+from services.codec import compress_content, decompress_content
 import threading
 import re
 import time
 import base64
+import hashlib
 import random
 import string
 
@@ -24,23 +27,42 @@ def NOW():
 
 
 class TGPart:
-  def __init__(self, messageid: int = 0, originalfilename: str = '', fileid: str = '', size: int = 0, index: int = -1, hash: str | None = None):
+  def __init__(self, messageid: int = 0, originalfilename: str = '', fileid: str = '', size: int = 0, index: int = -1, hash: str | None = None, access_hash: int | None = None, dc_id: int | None = None, file_reference: bytes | None = None, offset: int = 0):
     self.messageid = messageid
     self.originalfilename = originalfilename
     self.fileid = fileid
     self.size = size
     self.index = index
     self.hash = hash
+    # document location on telegram, avoids fetching the message before download
+    self.access_hash = access_hash
+    self.dc_id = dc_id
+    self.file_reference = file_reference
+    # position of the part inside the document, when it is packed with other small files
+    self.offset = offset
   
-  def toDB(self):
-    return {
+  def has_location(self):
+    return self.access_hash is not None and self.dc_id is not None and self.file_reference is not None
+
+  def toDB(self, for_web = False):
+    data = {
       'messageid': self.messageid,
       'originalfilename': self.originalfilename,
       'fileid': self.fileid,
       'size': self.size,
       'index': self.index,
-      'hash': self.hash
+      'hash': self.hash,
+      'access_hash': self.access_hash,
+      'dc_id': self.dc_id,
+      'file_reference': self.file_reference,
+      'offset': self.offset
     }
+    if for_web:
+      # binary data and telegram secrets are not exposed
+      del data['access_hash']
+      del data['file_reference']
+    
+    return data
 
 
 class TGItem:
@@ -64,14 +86,53 @@ class TGItem:
   def is_deleted(self):
     return self.state == 'DELETED'
   
+  # size of DB content when the item has been loaded without it
+  content_size = None
+
+  # SHA-256 of the whole content, None when it is not known
+  hash = None
+
+  # codec of DB content, None when it is stored as it is
+  content_codec = None
+  # size of DB content before compression
+  content_original_size = None
+
   def content_length(self):
-    if self.content is not None:
+    if self.content_codec is not None:
+      return self.content_original_size or 0
+    elif self.content is not None:
       return len( self.content )
+    elif self.content_size is not None:
+      return self.content_size
     else:
       return 0
   
+  def content_tag(self):
+    """
+    digest of the stored content: it changes with parts or DB content, not with name or folder
+    """
+    digest = hashlib.sha1()
+    if self.parts is not None and len(self.parts) > 0:
+      for part in self.parts:
+        if part.offset:
+          # files packed into the same document
+          digest.update( f"{self.channel}:{part.messageid}:{part.fileid}:{part.offset}:{part.size};".encode() )
+        else:
+          digest.update( f"{self.channel}:{part.messageid}:{part.fileid}:{part.size};".encode() )
+    else:
+      digest.update( f"{self.id}:{self.mtime.timestamp()}:{self.content_length()}".encode() )
+    return digest.hexdigest()
+
+  def get_content(self):
+    """
+    returns DB content as it has been written
+    """
+    if self.content is None:
+      return None
+    return decompress_content(self.content, self.content_codec)
+
   def is_on_telegram(self):
-    return self.content is None or self.content_length() == 0 and self.parts is not None and len(self.parts) > 0
+    return (self.content is None and not self.content_size) or self.content_length() == 0 and self.parts is not None and len(self.parts) > 0
   
   
   def toDB(self, for_web = False):
@@ -80,7 +141,7 @@ class TGItem:
     if self.parts is not None:
       parts = []
       for part in self.parts:
-        parts.append( part.toDB() )
+        parts.append( part.toDB(for_web) )
 
     data = {
       'id': self.id,
@@ -91,9 +152,12 @@ class TGItem:
       'type': self.type,
       'info': self.info,
       'content': self.content if not for_web else None,
+      'content_codec': self.content_codec,
+      'content_original_size': self.content_original_size,
+      'hash': self.hash,
       'state': self.state,
       'ctime': self.ctime if not for_web else self.ctime.timestamp(),
-      'mtime': self.mtime if not for_web else self.ctime.timestamp()
+      'mtime': self.mtime if not for_web else self.mtime.timestamp()
     }
     if for_web:
       data['content_length'] = self.content_length()
@@ -122,7 +186,11 @@ class TGItem:
           fileid = part.fileid,
           size = part.size,
           index = part.index,
-          hash = part.hash
+          hash = part.hash,
+          access_hash = part.access_hash,
+          dc_id = part.dc_id,
+          file_reference = part.file_reference,
+          offset = part.offset
         ))
       newitem.parts = newparts
 
@@ -130,6 +198,9 @@ class TGItem:
     newitem.type = self.type
     newitem.info = self.info
     newitem.content = self.content
+    newitem.content_codec = self.content_codec
+    newitem.content_original_size = self.content_original_size
+    newitem.hash = self.hash
     newitem.state = self.state
     newitem.ctime = self.ctime
     newitem.mtime = self.mtime
@@ -208,6 +279,12 @@ def init_database():
   global TGDB
   TGDB = database['tgsessions']
 
+  global PINDB
+  PINDB = database['pins']
+
+  global UPLOADDB
+  UPLOADDB = database['uploads']
+
   Log.info('database is ready!')
 
   rootfolder = getItem( ROOT_ID )
@@ -256,6 +333,10 @@ def remap(ret):
         part.size = p['size']
         part.index = p['index']
         part.hash = p['hash']
+        part.access_hash = p.get('access_hash', None)
+        part.dc_id = p.get('dc_id', None)
+        part.file_reference = p.get('file_reference', None)
+        part.offset = p.get('offset', 0)
 
         parts.append(part)
 
@@ -264,8 +345,17 @@ def remap(ret):
   item.type = ret['type']
   item.info = ret['info'] if 'info' in ret else {}
   item.content = ret['content'] if 'content' in ret else None
+  item.content_size = ret['content_size'] if 'content_size' in ret else None
+  item.content_codec = ret.get('content_codec', None)
+  item.content_original_size = ret.get('content_original_size', None)
+  item.hash = ret.get('hash', None)
   item.state = ret['state']
 
+  if 'ctime' in ret and isinstance(ret['ctime'], datetime.datetime):
+    item.ctime = ret['ctime'] if ret['ctime'].tzinfo else ret['ctime'].replace(tzinfo= datetime.UTC)
+  if 'mtime' in ret and isinstance(ret['mtime'], datetime.datetime):
+    item.mtime = ret['mtime'] if ret['mtime'].tzinfo else ret['mtime'].replace(tzinfo= datetime.UTC)
+
   if 'path' in ret:
     collpath = []
     for p in ret['path']:
@@ -304,6 +394,32 @@ def getItem(id, state = 'ACTIVE', session = None):
   
   return None
 
+def get_file_without_content(id, state = 'ACTIVE', session = None):
+  filter = {'id': id}
+  if state is not None:
+    filter['state'] = state
+
+  ret = DB.aggregate([
+    { '$match': filter },
+    { '$addFields': {
+      'content_size': {
+        '$cond': [ { '$eq': [ { '$type': '$content' }, 'binData' ] }, { '$binarySize': '$content' }, None ]
+      }
+    } },
+    { '$project': { 'content': 0 } }
+  ], session= session)
+
+  for item in ret:
+    return remap(item)
+
+  return None
+
+def get_file_content(id, session = None):
+  ret = DB.find_one({'id': id}, {'content': 1}, session= session)
+  if ret is not None:
+    return ret.get('content', None)
+  return None
+
 def getChildren(folderId, type = None, state = 'ACTIVE', ordered = False, session= None):
   filter = {
     'parentfolder': folderId
@@ -478,6 +594,8 @@ def update_folder(oldfolder: TGFolder, data: TGFolder, parent = None, session =
 
   # we can modify relative channel for this folder
   oldfolder.channel = data.channel if data.channel is not None else oldfolder.channel
+
+  oldfolder.mtime = NOW()
   
   ret = DB.update_one({'id': oldfolder.id}, {'$set': oldfolder.toDB()}, session = session)
   return getItem(oldfolder.id, session= session)
@@ -511,6 +629,12 @@ def create_file(file: TGFile, parent = None, session = None):
   if file.content is not None:
     if type( file.content ) is not bytes:
       file.content = base64.b64decode( file.content )
+    if file.content_codec is None:
+      file.hash = file.hash or get_content_hash( file.content )
+      file.content_original_size = len( file.content )
+      file.content, file.content_codec = compress_content( file.content )
+      if file.content_codec is None:
+        file.content_original_size = None
   
   if not file.id:
     file.id = get_UUID()
@@ -528,6 +652,12 @@ def create_file(file: TGFile, parent = None, session = None):
   return remap( obj )
 
 
+def same_parts(parts: list[TGPart] | None, others: list[TGPart] | None):
+  if parts is None or others is None:
+    return parts is others
+  key = lambda part: (part.messageid, str(part.fileid), part.size, part.offset)
+  return [ key(part) for part in parts ] == [ key(part) for part in others ]
+
 def update_file(oldfile: TGFile, data: TGFile, parent = None, session = None):
   # check existing
   if check_exist(
@@ -556,11 +686,23 @@ def update_file(oldfile: TGFile, data: TGFile, parent = None, session = None):
 
   insert['mtime'] = NOW()
 
+  insert['hash'] = data.hash
+  if not data.content and (data.parts is None or same_parts(data.parts, oldfile.parts)):
+    # moved or renamed files keep their content
+    insert['hash'] = data.hash or oldfile.hash
+
   if data.content:
     if type( data.content ) is not bytes:
       insert['content'] = base64.b64decode(data.content)
     else:
       insert['content'] = data.content
+
+    if data.content_codec is None:
+      # content is stored compressed when it gets smaller
+      insert['hash'] = data.hash or get_content_hash( insert['content'] )
+      original_size = len( insert['content'] )
+      insert['content'], insert['content_codec'] = compress_content( insert['content'] )
+      insert['content_original_size'] = original_size if insert['content_codec'] is not None else None
   
   # TODO: check if pass content or inherit from original file
   # elif file.content:
@@ -597,6 +739,37 @@ def get_file_by_message_id_and_channel(msgId: int, channel: str, state = None, s
   if ret is not None:
     return remap(ret)
 
+def get_file_by_hash(hash: str, size: int, session= None):
+  """
+  returns an ACTIVE file stored on telegram with the given content and size
+  """
+  filter = {
+    'type': { '$not': { '$eq': 'folder' } },
+    'hash': hash,
+    'state': 'ACTIVE',
+    'parts.0': { '$exists': True }
+  }
+
+  for ret in DB.find(filter, session= session):
+    item = remap(ret)
+    if sum( part.size for part in item.parts ) == size:
+      return item
+
+  return None
+
+def count_message_references(msgId: int, channel: str, exclude_id = None, session= None):
+  """
+  counts the entries, in any state, whose parts are stored in the given message
+  """
+  filter = {
+    'channel': channel,
+    'parts.messageid': msgId
+  }
+  if exclude_id is not None:
+    filter['id'] = { '$ne': exclude_id }
+
+  return DB.count_documents(filter, session= session)
+
 def get_file_by_filename_and_channel(filename: str, channel: str, msgid: int = None, session= None):
 
   fn = re.sub("/", "-", filename, flags=re.IGNORECASE)
@@ -619,6 +792,63 @@ def get_file_by_filename_and_channel(filename: str, channel: str, msgid: int = N
     return remap(ret)
   pass
 
+def update_part_location(channel: str, msgId: int, access_hash: int, dc_id: int, file_reference: bytes, session= None):
+  filter = {
+    'type': { '$not': { '$eq': 'folder' } },
+    'channel': channel,
+    'parts.messageid': msgId
+  }
+
+  ret = DB.update_many(filter, {
+    '$set': {
+      'parts.$[part].access_hash': access_hash,
+      'parts.$[part].dc_id': dc_id,
+      'parts.$[part].file_reference': file_reference
+    }
+  }, array_filters= [ {'part.messageid': msgId} ], session= session)
+
+  return ret.modified_count
+
+def get_parts_dcs(session= None):
+  filter = {
+    'type': { '$not': { '$eq': 'folder' } },
+    'state': 'ACTIVE'
+  }
+  dcs = DB.distinct('parts.dc_id', filter, session= session)
+  return [ dc for dc in dcs if dc is not None ]
+
+def get_files_without_location(session= None):
+  filter = {
+    'type': { '$not': { '$eq': 'folder' } },
+    'state': 'ACTIVE',
+    'parts': { '$elemMatch': { 'file_reference': None } }
+  }
+  ret = DB.find(filter, session= session)
+  res = []
+  for item in ret:
+    res.append( remap(item) )
+  return res
+
+def get_files_with_content(session= None):
+  filter = {
+    'type': { '$not': { '$eq': 'folder' } },
+    'content': { '$type': 'binData' }
+  }
+  return DB.find(filter, session= session)
+
+def update_file_content(id, content: bytes, codec: str | None, original_size: int | None, hash: str, session= None):
+  """
+  replaces DB content with the same content, differently encoded
+  """
+  DB.update_one({'id': id}, {
+    '$set': {
+      'content': content,
+      'content_codec': codec,
+      'content_original_size': original_size,
+      'hash': hash
+    }
+  }, session= session)
+
 def get_folders_by_channel(channelId: str, session= None):
   filter = {
     'type': 'folder',
@@ -646,6 +876,55 @@ def get_tg_session(key):
   return None
 
 
+def count_file_access(id):
+  """
+  increments the access counter of an item, returning its pin record
+  """
+  return PINDB.find_one_and_update(
+    {'_id': id},
+    {
+      '$inc': {'hits': 1},
+      '$set': {'last_access': NOW()},
+      '$setOnInsert': {'state': None, 'manual': False, 'size': 0, 'tag': None}
+    },
+    upsert= True,
+    return_document= ReturnDocument.AFTER
+  )
+
+def get_pin(id):
+  return PINDB.find_one({'_id': id})
+
+def get_pins(state = None):
+  filter = {}
+  if state is not None:
+    filter['state'] = state
+  return list( PINDB.find(filter) )
+
+def update_pin(id, **values):
+  PINDB.update_one({'_id': id}, {'$set': values}, upsert= True)
+
+def remove_pin(id):
+  PINDB.delete_one({'_id': id})
+
+
+def get_upload(id):
+  return UPLOADDB.find_one({'_id': id})
+
+def save_upload(id, **values):
+  UPLOADDB.update_one({'_id': id}, {'$set': values}, upsert= True)
+
+def save_upload_portion(id, index, **values):
+  update = { f"portions.{index}.{key}": value for key, value in values.items() }
+  update[f"portions.{index}.updated"] = NOW()
+  UPLOADDB.update_one({'_id': id}, {'$set': update}, upsert= True)
+
+def remove_upload(id):
+  UPLOADDB.delete_one({'_id': id})
+
+def reset_file_parts(id, session= None):
+  DB.update_one({'id': id}, {'$set': {'parts': None}}, session= session)
+
+
 def get_UUID():
   alphabet = string.ascii_lowercase + string.digits
   return ''.join( random.choices(alphabet, k=10) )
@@ -691,6 +970,7 @@ def create_collections(database):
     coll.create_index( ('filename', TEXT) )
     coll.create_index( ('parentfolder', TEXT) )
     coll.create_index( ['filename', 'parentfolder', 'state'] )
+    coll.create_index( ['hash', 'state'] )
     
   except Exception as e:
     Log.warning(f"error occurred while creating indexes for entries")
@@ -705,6 +985,22 @@ def create_collections(database):
     Log.warning(f"error occurred while create schema for tgsessions")
     Log.warning(e)
 
+  try:
+
+    database.create_collection('pins')
+    
+  except Exception as e:
+    Log.warning(f"error occurred while create schema for pins")
+    Log.warning(e)
+
+  try:
+
+    database.create_collection('uploads')
+    
+  except Exception as e:
+    Log.warning(f"error occurred while create schema for uploads")
+    Log.warning(e)
+
 def check_transaction():
 
   global CAN_TRANSACTION
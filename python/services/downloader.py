@@ -1,18 +1,124 @@
-from services.telegram import TelegramApi
-from services.database import TGFile
-from configuration import UPLOAD_CHUNK
+from services.telegram import TelegramApi, FileLocation
+from services.tgclients import TGClients
+from pyrogram.errors import FileReferenceExpired, FloodWait, FileMigrate
+from services.database import TGFile, update_part_location, get_file_content
+from services import chunkcache
+from services.codec import iter_content
+from configuration import Config
+from constants import UPLOAD_CHUNK
+from collections import deque
+import asyncio
 import logging
+import math
+import time
 
 Log = logging.getLogger('Downloader')
 
 PART_TO_LOG_DEBUG = 100 * 1024 * 1024
 PART_TO_LOG_INFO = 500 * 1024 * 1024
 
+# telegram chunk (1MB)
+CHUNK = UPLOAD_CHUNK * 2
+
+# smallest telegram request
+MIN_LIMIT = 4 * 1024
+
+# seconds to wait before retrying a failed chunk, doubled at each retry
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 10
+# failures before switching to another client
+RETRIES_PER_CLIENT = 2
+
+# (media_id, offset, limit) -> pending telegram request, shared by all streams
+InFlight = {}
+
+
+class ByteBudget():
+
+  size = 0
+  available = 0
+
+  def __init__(self, size: int):
+    self.size = size
+    self.available = size
+    # (amount, future) served in order
+    self.waiters = deque()
+
+  async def acquire(self, amount: int):
+    # a single request larger than the budget would wait forever
+    amount = min(amount, self.size)
+
+    if len(self.waiters) == 0 and self.available >= amount:
+      self.available -= amount
+      return amount
+
+    waiter = asyncio.get_running_loop().create_future()
+    self.waiters.append( (amount, waiter) )
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      if waiter.done() and not waiter.cancelled():
+        # budget has been assigned right before cancellation
+        self.release(amount)
+      elif (amount, waiter) in self.waiters:
+        self.waiters.remove( (amount, waiter) )
+        self.wake()
+      raise
+
+    return amount
+
+  def release(self, amount: int):
+    amount = min(amount, self.size)
+    self.available = min(self.available + amount, self.size)
+    self.wake()
+
+  def wake(self):
+    while len(self.waiters) > 0:
+      amount, waiter = self.waiters[0]
+      if waiter.done():
+        self.waiters.popleft()
+        continue
+      if self.available < amount:
+        break
+      self.available -= amount
+      self.waiters.popleft()
+      waiter.set_result(True)
+
+
+# memory used by chunks of all active downloads
+MemoryBudget = ByteBudget(Config.telegram.download.memory)
+
+
+def get_request_range(start, end):
+  """
+  returns the smallest (offset, limit, precise) telegram request which covers
+  bytes [start, end) without crossing a 1MB boundary
+  """
+  block = start - (start % CHUNK)
+  if end - block > CHUNK:
+    return block, CHUNK, False
+
+  # default mode: limit must divide 1MB and offset must be aligned to limit
+  limit = MIN_LIMIT
+  while limit < CHUNK and (start - (start % limit)) + limit < end:
+    limit *= 2
+  request = (start - (start % limit), limit, False)
+
+  if Config.telegram.download.precise:
+    # precise mode: offset aligned to 1KB, limit multiple of 4KB up to the block end
+    offset = start - (start % 1024)
+    precise_limit = min( math.ceil( (end - offset) / MIN_LIMIT ) * MIN_LIMIT, block + CHUNK - offset )
+    if precise_limit < request[1]:
+      request = (offset, precise_limit, True)
+
+  return request
+
 class Downloader():
   
   aborted = False
 
   client = None
+  clients = None
   channel_id = None
   parts = None
   range_start = 0
@@ -20,8 +126,9 @@ class Downloader():
   totalsize = 0
   file = None
 
-  def __init__(self, client: TelegramApi, file: TGFile, start: int, end: int):
+  def __init__(self, client: TelegramApi, file: TGFile, start: int, end: int, clients: list[TelegramApi] | None = None):
     self.client = client
+    self.clients = clients or [ client ]
     self.channel_id = file.channel
     self.file = file
     self.parts = file.parts
@@ -33,7 +140,7 @@ class Downloader():
     if file.parts is not None:
       for part in file.parts:
         self.totalsize += part.size
-    elif file.content and file.content_length() > 0:
+    elif file.content_length() > 0:
       self.totalsize = file.content_length()
     
   
@@ -41,18 +148,13 @@ class Downloader():
     self.aborted = True
   
 
-  async def execute(self, destination, awaited = True):
+  async def execute(self, destination, awaited = True, eof = True):
 
-    files = []
-
-    currentSizePosition = 0
-    currentIndex = 0
+    if self.file and self.file.parts is None and self.file.content_length() > 0:
+      await self.stream_content(destination, awaited)
 
-    if self.file and self.file.content is not None and self.file.parts is None: # and self.file.content_length():
-      if awaited:
-        await destination.write( file.content )
-      else:
-        destination.write( file.content )
+      if not eof:
+        return
       
       try:
         if awaited:
@@ -64,6 +166,55 @@ class Downloader():
       
       return
 
+    files = self.get_part_ranges()
+
+    for index, item in enumerate(files):
+
+      start = item['start']
+      end = item['end']
+      file = item['file']
+      msg = file.messageid
+      
+      known = None
+      if file.has_location():
+        known = FileLocation(int(file.fileid), file.access_hash, file.file_reference, file.dc_id)
+
+      Log.debug(f"getting location of message {msg}")
+      try:
+        location = await self.client.get_file_location(self.channel_id, msg, known= known)
+      except Exception as e:
+        Log.error(e)
+        raise e
+  
+      Log.debug(f"ready for download, range: {start}-${end}")
+
+      Log.info(f"serve part {index}/{len(files)}, range: {start}-${end}/{file.size} -> [{file.index}] '{file.originalfilename}'")
+
+      # a packed file is a range of a document shared with other files
+      await self.perform_stream(msg, location, file.offset + start, file.offset + end, file.offset + file.size, destination, awaited)
+
+      if ( self.aborted ):
+        break
+
+    if not eof:
+      # destination is shared with other ranges (multipart response)
+      return
+    
+    try:
+      await destination.write_eof()    
+    except Exception:
+      Log.warn(f"cannot write_eof")
+
+  
+  def get_part_ranges(self):
+    """
+    returns the parts covering the requested range, with start and end offsets inside each part
+    """
+    files = []
+
+    currentSizePosition = 0
+    currentIndex = 0
+
     # Calculate the full range stack to be downloaded
     while( True ):
 
@@ -92,44 +243,263 @@ class Downloader():
       
       currentSizePosition += file.size
       currentIndex += 1
+
+    return files
+
+
+  async def get_content(self):
+    if self.file.content is not None:
+      return self.file.content
+
+    # item has been loaded without its content
+    key = (self.file.id, self.file.mtime.timestamp())
+    if chunkcache.MemoryCache is not None:
+      content = chunkcache.MemoryCache.get(*key)
+      if content is not None:
+        Log.debug(f"content of '{self.file.filename}' served from memory cache")
+        return content
+
+    content = await asyncio.to_thread(get_file_content, self.file.id)
+    if content is None:
+      raise Exception(f"file '{self.file.filename}' has no content")
+
+    if chunkcache.MemoryCache is not None:
+      chunkcache.MemoryCache.put(*key, content)
+
+    return content
+
+
+  async def stream_content(self, destination, awaited = True):
+    start = self.range_start
+    end = self.range_end + 1 if self.range_end > -1 else self.totalsize
+
+    if self.file.content_codec is not None:
+      await self.stream_compressed_content(destination, start, end, awaited)
+      return
+
+    # write slices of the same buffer, without copying it
+    content = memoryview( await self.get_content() )[start : end]
+
+    Log.info(f"serve DB content, range: {start}-{end}/{self.totalsize} -> '{self.file.filename}'")
+
+    for position in range(0, len(content), CHUNK):
+      if awaited:
+        await destination.write( content[position : position + CHUNK] )
+      else:
+        destination.write( content[position : position + CHUNK] )
+      if self.aborted:
+        break
+
+
+  async def stream_compressed_content(self, destination, start, end, awaited = True):
+    """
+    decompresses DB content block by block, out of the event loop, until the end of the range
+    """
+    content = await self.get_content()
+
+    Log.info(f"serve DB content ({self.file.content_codec}), range: {start}-{end}/{self.totalsize} -> '{self.file.filename}'")
+
+    blocks = iter_content(content, self.file.content_codec, CHUNK)
+    position = 0
+    while position < end and not self.aborted:
+      block = await asyncio.to_thread(next, blocks, None)
+      if block is None:
+        break
+
+      first = max(start - position, 0)
+      last = min(end - position, len(block))
+      position += len(block)
+      if first >= last:
+        continue
+
+      buf = block if first == 0 and last == len(block) else memoryview(block)[first : last]
+      if awaited:
+        await destination.write( buf )
+      else:
+        destination.write( buf )
+
+
+  async def fetch_chunk(self, client: TelegramApi, msg, location: FileLocation, offset, limit, size, precise = False, keep = False):
+    id = location.media_id
+
+    # caches only contain entire chunks
+    block = offset - (offset % CHUNK)
+    hot = chunkcache.MemoryCache is not None and ( keep or chunkcache.MemoryCache.is_hot_region(block, CHUNK, size) )
+
+    data = None
+    if chunkcache.MemoryCache is not None:
+      # chunks out of the hot regions are there when they have been read ahead
+      data = chunkcache.MemoryCache.get(id, block)
+      if data is not None:
+        Log.debug(f"chunk {block} of {id} served from memory cache")
+
+    if data is None and chunkcache.DiskCache is not None:
+      data = await chunkcache.DiskCache.get(id, block)
+      if data is not None:
+        Log.debug(f"chunk {block} of {id} served from disk cache")
+        if hot:
+          chunkcache.MemoryCache.put(id, block, data)
+
+    if data is not None:
+      if offset == block and limit >= len(data):
+        return data
+      return memoryview(data)[offset - block : offset - block + limit]
+
+    # share the same telegram request between concurrent streams
+    key = (id, offset, limit)
+    request = InFlight.get(key, None)
+    if request is None:
+      request = asyncio.ensure_future( self.download_chunk(client, msg, location, offset, limit, precise, hot) )
+      InFlight[key] = request
+
+      def on_done(task):
+        InFlight.pop(key, None)
+        if not task.cancelled():
+          # avoid "exception was never retrieved" when all streams are gone
+          task.exception()
+
+      request.add_done_callback(on_done)
+    else:
+      Log.debug(f"chunk {offset} of {id} is already being downloaded, wait for it")
+
+    # a stream which is aborted must not cancel the request for the others
+    return await asyncio.shield(request)
+
+
+  async def download_chunk(self, client: TelegramApi, msg, location: FileLocation, offset, limit, precise = False, hot = False):
+    id = location.media_id
+    retries = Config.telegram.download.retries
+    attempt = 0
+    # client which `location` belongs to
+    resolved = self.client
+
+    while True:
+      try:
+        if client is not resolved:
+          # each client uses its own file reference
+          location = await client.get_file_location(self.channel_id, msg)
+          resolved = client
+
+        tgFile = await client.get_file(id, location.access_hash, location.file_reference, offset=offset, limit=limit, dc=location.dc_id, precise=precise)
+        break
+
+      except FileReferenceExpired:
+        Log.debug(f"file reference of message {msg} is expired, refresh it")
+        location = await client.get_file_location(self.channel_id, msg, expired= location)
+        # keep the last known reference for next downloads
+        update_part_location(self.channel_id, msg, location.access_hash, location.dc_id, location.file_reference)
+        error = None
+        wait = 0
+
+      except FloodWait as e:
+        Log.warning(f"client {client.username} must wait {e.value}s before downloading chunk {offset} of {id}")
+        client.flood_until = time.monotonic() + e.value
+        error = e
+        wait = e.value
+
+      except FileMigrate as e:
+        Log.debug(f"chunk {offset} of {id} is located in DC {e.value}")
+        location = FileLocation(location.media_id, location.access_hash, location.file_reference, e.value)
+        error = e
+        wait = 0
+
+      except Exception as e:
+        Log.warning(f"error while downloading chunk {offset} of {id} with client {client.username}: {e}")
+        error = e
+        wait = min( RETRY_BACKOFF * (2 ** attempt), RETRY_MAX_BACKOFF )
+
+      attempt += 1
+      if attempt > retries:
+        Log.error(f"cannot download chunk {offset} of {id} after {retries} retries")
+        raise error or Exception(f"cannot download chunk {offset} of {id}")
+
+      if isinstance(error, FloodWait) or (error is not None and attempt % RETRIES_PER_CLIENT == 0):
+        fallback = self.get_fallback_client(client)
+        if fallback is not client:
+          Log.info(f"switch client {client.username} -> {fallback.username} for chunk {offset} of {id}")
+          client = fallback
+          wait = max( 0, client.flood_until - time.monotonic() )
+
+      if wait > 0:
+        await asyncio.sleep(wait)
+
+    if limit == CHUNK and offset % CHUNK == 0:
+      if hot:
+        chunkcache.MemoryCache.put(id, offset, tgFile.bytes)
+      if chunkcache.DiskCache is not None:
+        chunkcache.DiskCache.put(id, offset, tgFile.bytes)
+
+    return tgFile.bytes
+
+
+  def get_fallback_client(self, failed: TelegramApi):
+    candidates = self.clients + [ c for c in TGClients.get_all_clients() if c not in self.clients ]
+    if len(candidates) <= 1:
+      return failed
+
+    # prefer the next client which is not waiting for a FLOOD_WAIT
+    index = candidates.index(failed) if failed in candidates else -1
+    ordered = candidates[index + 1 :] + candidates[ : index + 1]
+    now = time.monotonic()
+    for client in ordered:
+      if client.flood_until <= now:
+        return client
     
-    
-    for index, item in enumerate(files):
+    return min(ordered, key= lambda c: c.flood_until)
 
-      start = item['start']
-      end = item['end']
+
+  async def prefetch(self):
+    """
+    downloads the entire chunks of the requested range into the memory cache, without streaming them
+    """
+    if self.parts is None or chunkcache.MemoryCache is None:
+      return
+
+    requests = asyncio.Semaphore( max(Config.telegram.download.prefetch, len(self.clients)) )
+    tasks = []
+
+    async def fetch(client, msg, location, offset, size):
+      async with requests:
+        if not self.aborted:
+          await self.fetch_chunk(client, msg, location, offset, CHUNK, size, keep= True)
+
+    for item in self.get_part_ranges():
       file = item['file']
       msg = file.messageid
-      
-      Log.debug(f"getting message {msg}")
-      message = await self.client.get_message(self.channel_id, msg)
-      if message is None:
-        Log.error(f"no message found with id '{msg}' in chat '{self.channel_id}'")
-        raise Exception(f"no message found with id '{msg}' in chat '{self.channel_id}'")
-      
-      media = TelegramApi.get_media_from_message( message )
-  
-      Log.debug(f"ready for download, range: {start}-${end}")
 
-      Log.info(f"serve part {index}/{len(files)}, range: {start}-${end}/{file.size} -> [{file.index}] '{file.originalfilename}'")
+      known = None
+      if file.has_location():
+        known = FileLocation(int(file.fileid), file.access_hash, file.file_reference, file.dc_id)
 
-      await self.perform_stream(media.filedata.media_id, media.filedata.access_hash, media.filedata.file_reference, media.filedata.dc_id, start, end, destination, awaited)
+      location = await self.client.get_file_location(self.channel_id, msg, known= known)
 
-      if ( self.aborted ):
-        break
-    
-    try:
-      await destination.write_eof()    
-    except Exception:
-      Log.warn(f"cannot write_eof")
+      start = file.offset + item['start']
+      for offset in range(start - (start % CHUNK), file.offset + item['end'], CHUNK):
+        if chunkcache.MemoryCache.get(location.media_id, offset) is not None:
+          continue
+        client = self.clients[ len(tasks) % len(self.clients) ]
+        tasks.append( asyncio.ensure_future( fetch(client, msg, location, offset, file.offset + file.size) ) )
 
-  
-  async def perform_stream(self, id, hash, reference, dc, start, end, destination, awaited = True):
-    # telegram chunk (1MB)
-    CHUNK = UPLOAD_CHUNK * 2 # 1 Mb
-  
+    # best effort: a chunk which cannot be read ahead is downloaded by the stream
+    results = await asyncio.gather(*tasks, return_exceptions= True)
+    failed = [ r for r in results if isinstance(r, Exception) ]
+    if len(failed) > 0:
+      Log.debug(f"cannot read ahead {len(failed)} of {len(tasks)} chunks of '{self.file.filename}': {failed[0]}")
+
+
+  async def perform_stream(self, msg, location: FileLocation, start, end, size, destination, awaited = True):
     # calculate the start offset of download
     offset = start - (start % CHUNK)
+    limit = CHUNK
+    precise = False
+
+    # head and tail chunks are downloaded entirely, so they are kept into memory cache
+    hot = chunkcache.MemoryCache is not None and chunkcache.MemoryCache.is_hot_region(offset, CHUNK, size)
+
+    if end - offset <= CHUNK and not hot:
+      # small range: do not download the entire chunk
+      offset, limit, precise = get_request_range(start, end)
+
     first = True
   
     needStop = False
@@ -138,42 +508,114 @@ class Downloader():
 
     offset = int(offset)
 
-    Log.debug(f"stream from {start} to {end}, starting from {offset}")
+    # consecutive chunks are striped between clients
+    window = max(Config.telegram.download.prefetch, len(self.clients))
 
-    while (True):
-      tgFile = await self.client.get_file(id, hash, reference, offset=offset, limit=CHUNK, dc=dc)
-  
-      firstByte = 0
-      lastByte = CHUNK
-  
-      if ( first ):
-        firstByte = start - offset
-        first = False
-  
-      if ( offset + len(tgFile.bytes) >= end ):
-        lastByte = end - offset
-        needStop = True
-      
-      firstByte = int(firstByte)
-      lastByte = int(lastByte)
-  
-      buf = tgFile.bytes[firstByte : lastByte]
-      # Log.debug(f"send buffer: from {offset} ({len(buf)} bytes)")
-      if awaited:
-        resp = await destination.write( buf )
-      else:
-        resp = destination.write( buf )
-      
-      total_file_downloaded += len(buf)
+    Log.debug(f"stream from {start} to {end}, starting from {offset} (limit: {limit}, precise: {precise}), prefetch: {window}, clients: {len(self.clients)}")
 
-      if total_file_downloaded % PART_TO_LOG_DEBUG == 0:
-        Log.debug(f"downloaded {total_file_downloaded} bytes of '{self.file.filename}'")
-      if total_file_downloaded % PART_TO_LOG_INFO == 0:
-        Log.info(f"downloaded {total_file_downloaded} bytes of '{self.file.filename}'")
+    # chunks requested to telegram and not yet written, ordered by offset
+    pending = deque()
+    next_offset = offset
+    next_index = 0
 
-      #Log.debug(f"wrote {len(buf) == resp}, {len(buf)} bytes")
+    # bytes requested and not yet written: by this stream and by all downloads
+    stream_budget = ByteBudget( max(Config.telegram.download.stream_buffer, limit) )
+    reserved = 0
 
-      offset += CHUNK
-  
-      if ( needStop or self.aborted ):
-        break
\ No newline at end of file
+    # telegram requests running at the same time for this stream
+    requests = asyncio.Semaphore(window)
+
+    available = asyncio.Event()
+    produced = False
+
+    async def produce():
+      nonlocal next_offset, next_index, reserved, produced
+      try:
+        while next_offset < end and not self.aborted:
+          # wait for a slow destination or for other streams to free memory
+          await stream_budget.acquire(limit)
+          acquired = await MemoryBudget.acquire(limit)
+          reserved += acquired
+          await requests.acquire()
+
+          client = self.clients[ next_index % len(self.clients) ]
+          task = asyncio.ensure_future( self.fetch_chunk(client, msg, location, next_offset, limit, size, precise) )
+          task.add_done_callback(lambda _: requests.release())
+          pending.append( (next_offset, task) )
+          available.set()
+
+          next_offset += limit
+          next_index += 1
+      finally:
+        produced = True
+        available.set()
+
+    producer = asyncio.ensure_future( produce() )
+
+    try:
+
+      while True:
+
+        while len(pending) == 0 and not produced:
+          available.clear()
+          await available.wait()
+
+        if len(pending) == 0:
+          break
+
+        offset, task = pending.popleft()
+        chunk = await task
+    
+        firstByte = 0
+        lastByte = CHUNK
+    
+        if ( first ):
+          firstByte = start - offset
+          first = False
+    
+        if ( offset + len(chunk) >= end ):
+          lastByte = end - offset
+          needStop = True
+        
+        firstByte = int(firstByte)
+        lastByte = int(lastByte)
+    
+        # memoryview: trimming does not copy the chunk
+        buf = chunk if firstByte == 0 and lastByte >= len(chunk) else memoryview(chunk)[firstByte : lastByte]
+        # Log.debug(f"send buffer: from {offset} ({len(buf)} bytes)")
+        if awaited:
+          resp = await destination.write( buf )
+        else:
+          resp = destination.write( buf )
+
+        # chunk has been handed to destination, the producer can go on
+        stream_budget.release(limit)
+        MemoryBudget.release(limit)
+        reserved -= min(limit, MemoryBudget.size)
+        
+        total_file_downloaded += len(buf)
+
+        if total_file_downloaded % PART_TO_LOG_DEBUG == 0:
+          Log.debug(f"downloaded {total_file_downloaded} bytes of '{self.file.filename}'")
+        if total_file_downloaded % PART_TO_LOG_INFO == 0:
+          Log.info(f"downloaded {total_file_downloaded} bytes of '{self.file.filename}'")
+
+        #Log.debug(f"wrote {len(buf) == resp}, {len(buf)} bytes")
+    
+        if ( needStop or self.aborted ):
+          break
+
+      if producer.done() and not producer.cancelled() and producer.exception() is not None:
+        raise producer.exception()
+    
+    finally:
+      producer.cancel()
+
+      # drop requests which are not needed anymore
+      for _, task in pending:
+        if not task.cancel() and not task.cancelled():
+          task.exception()
+
+      # give back memory of chunks which have not been written
+      if reserved > 0:
+        MemoryBudget.release(reserved)
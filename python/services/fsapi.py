@@ -1,5 +1,5 @@
 import logging
-from services.database import TGFolder, TGFile, TGPart, start_session, list_file_in_folder_recursively, getItem, removeItem, purgeItem, create_file, update_file, getItemByFilename, getChildren, create_folder, remap, update_folder
+from services.database import TGFolder, TGFile, TGPart, start_session, list_file_in_folder_recursively, getItem, removeItem, purgeItem, create_file, update_file, getItemByFilename, getChildren, create_folder, remap, update_folder, get_upload, save_upload, save_upload_portion, remove_upload, reset_file_parts, get_file_by_hash, count_message_references
 from constants import ROOT_ID
 from configuration import Config
 from services.telegram import TelegramApi
@@ -100,7 +100,7 @@ class FSApi():
         for part in file.parts:
           size += part.size
       elif ( file.content is not None):
-        size = len(file.content)
+        size = file.content_length()
         
     
     return size
@@ -420,11 +420,14 @@ class FSApi():
     if ( file is None ):
       raise Exception(f"'{path}' not found")
 
+    return await self.read_item_content(file, start, end)
+
+  async def read_item_content(self, file: TGFile, start = 0, end = -1):
     totalsize = 0
     if ( file.parts is not None and len(file.parts) > 0 ):
       for part in file.parts:
         totalsize += part.size
-    elif ( file.content is not None):
+    else:
       totalsize = file.content_length()
 
     if end == -1:
@@ -434,9 +437,11 @@ class FSApi():
 
     client = TGClients.next_client(True)
 
-    Log.info(f"serve file '{filename}', bytes: {start}-{end}, total: {totalsize}")
+    clients = TGClients.get_download_clients(Config.telegram.download.stripe, client)
+
+    Log.info(f"serve file '{file.filename}', bytes: {start}-{end}, total: {totalsize}, using {len(clients)} clients")
 
-    service = Downloader(client, file, start, end)
+    service = Downloader(client, file, start, end, clients)
 
     return service
 
@@ -470,18 +475,40 @@ class FSApi():
     else:
       Log.info(f"file will be uploaded in channel: {channelid}")
 
-    client = TGClients.next_client()
-
     session, transation = start_session()
 
     with transation:
 
-      uploader = Uploader(client, filename, channelid)
-
       dbFile = getItemByFilename(filename, folder.id, state = None, session= session)
+
+      checkpoint = None
       if dbFile is not None and dbFile.state == 'TEMP':
         Log.warning(f"already existing TEMPORARY file '{filename}' in '{folder.filename}'")
 
+        checkpoint = get_upload(dbFile.id)
+        if checkpoint is None:
+          # interrupted before any progress: start again
+          purgeItem(dbFile.id, session= session)
+
+      # parts already sent belong to the accounts which uploaded them
+      owners = []
+      if checkpoint is not None:
+        for _, state in sorted( checkpoint.get('portions', {}).items(), key= lambda item: int(item[0]) ):
+          owner = TGClients.get_user_client( state.get('client', None) )
+          if owner is not None and owner not in owners:
+            owners.append(owner)
+
+      client = owners[0] if len(owners) > 0 else TGClients.next_client()
+      clients = TGClients.get_upload_clients(Config.telegram.upload.stripe, client, owners)
+      uploader = Uploader(client, filename, channelid, clients)
+
+      resumed = False
+      if checkpoint is not None:
+        saved = [ part.index for part in dbFile.parts or [] ]
+        Log.info(f"resume upload of '{filename}' [{dbFile.id}] with {[ c.username for c in clients ]}, {len(saved)} portions already saved")
+        uploader.resume(checkpoint, saved)
+        resumed = True
+
       if dbFile is not None and dbFile.id:
 
         if dbFile.state == 'DELETED':
@@ -502,35 +529,69 @@ class FSApi():
       #   ), folder.id, session= session)
       # else:
 
-      # create a new temp file for the uploading file
-      dbFile = create_file(TGFile(
-        filename = filename,
-        channel = channelid,
-        type = mimetypes.guess_type(filename)[0],
-        parentfolder = folder.id,
-        state = 'TEMP'
-      ), folder.id, session= session)
+      if not resumed:
+        # create a new temp file for the uploading file
+        dbFile = create_file(TGFile(
+          filename = filename,
+          channel = channelid,
+          type = mimetypes.guess_type(filename)[0],
+          parentfolder = folder.id,
+          state = 'TEMP'
+        ), folder.id, session= session)
 
 
       def on_stopped(*args):
         Log.warning(f"Process aborted, remove item: {dbFile.id} - {dbFile.filename}")
         purgeItem(dbFile.id, session= session)
+        remove_upload(dbFile.id)
 
       uploader.on('stopped', on_stopped)
       uploader.on('error', on_stopped)
                     
 
-      def on_complete_upload(*args):
+      def on_complete_upload(parts, channel_id, hash):
 
         newFileData = getItem(dbFile.id, state = None, session= session)
         newFileData.state = 'ACTIVE'
+        newFileData.hash = hash
         update_file(dbFile, newFileData, session= session)
 
         Log.info(f"File has been processed: [{dbFile.id}] '{dbFile.filename}'")
+        remove_upload(dbFile.id)
 
       uploader.on('completeUpload', on_complete_upload)
 
 
+      # checkpoints of local files, in order to resume the upload after a restart
+      def on_upload_started(size, mtime, portion_size):
+        save_upload(dbFile.id, size= size, mtime= mtime, portion_size= portion_size, portions= {})
+
+      def on_portion_progress(index, file_id, parts, client):
+        save_upload_portion(dbFile.id, index, file_id= file_id, parts= parts, client= client)
+
+      def on_portion_moved(portion):
+        save_upload_portion(dbFile.id, portion.index, message= {
+          'msg_id': portion.msg_id,
+          'file_id': portion.file_id,
+          'filename': portion.filename,
+          'size': portion.size,
+          'offset': portion.offset,
+          'access_hash': portion.access_hash,
+          'dc_id': portion.dc_id,
+          'file_reference': portion.file_reference
+        })
+
+      def on_reset_upload(*args):
+        Log.info(f"discard previous upload of '{dbFile.filename}' [{dbFile.id}]")
+        remove_upload(dbFile.id)
+        reset_file_parts(dbFile.id, session= session)
+
+      uploader.on('uploadStarted', on_upload_started)
+      uploader.on('portionProgress', on_portion_progress)
+      uploader.on('portionMoved', on_portion_moved)
+      uploader.on('resetUpload', on_reset_upload)
+
+
       def on_portion_upload(portion, *args):
         Log.debug(f"Portion of file has been uploaded, save it into DB: {vars(portion)}")
 
@@ -542,6 +603,7 @@ class FSApi():
         if portion.content is not None:
           # file will be stored in DB
           newFileData.content = portion.content
+          newFileData.content_codec = None
           newFileData.parts = None
         else:
           newFileData.content = None
@@ -550,10 +612,14 @@ class FSApi():
           newFileData.parts.append( TGPart(
             messageid = portion.msg_id,
             originalfilename = portion.filename,
-            hash = '',
+            hash = portion.hash or '',
             fileid = str(portion.file_id),
             size = int(portion.size),
-            index = portion.index
+            index = portion.index,
+            access_hash = portion.access_hash,
+            dc_id = portion.dc_id,
+            file_reference = portion.file_reference,
+            offset = portion.offset
           ) )
 
           # newFileData.state = 'ACTIVE'
@@ -568,6 +634,58 @@ class FSApi():
     
     return uploader
 
+  async def create_file_from_duplicate(self, path: str, size: int, hash: str, stop_if_exists = False):
+    """
+    creates the file at `path` referencing the telegram parts of an ACTIVE file with the same content.
+    Returns None when there is no such file and the content must be uploaded
+    """
+    if not Config.telegram.upload.dedup or not hash:
+      return None
+
+    source = get_file_by_hash(hash, size)
+    if source is None:
+      return None
+
+    paths = self.split_path(path)
+    folder = self.get_last_folder(path, True)
+
+    if folder is None:
+      raise Exception(f"'{path}' not found")
+
+    filename = paths.pop()
+
+    session, transation = start_session()
+
+    with transation:
+
+      dbFile = getItemByFilename(filename, folder.id, state = None, session= session)
+      if dbFile is not None:
+        if dbFile.state == 'ACTIVE':
+          if stop_if_exists:
+            raise Exception(f"file '{dbFile.filename}' already exists in '{folder.filename}'")
+          # let the upload replace it as usual
+          return None
+
+        Log.warning(f"remove {dbFile.state} file '{dbFile.filename}' from '{folder.filename}'")
+        purgeItem(dbFile.id, session= session)
+        remove_upload(dbFile.id)
+
+      newfile = TGFile(
+        filename = filename,
+        channel = source.channel,
+        parts = source.clone().parts,
+        type = mimetypes.guess_type(filename)[0] or source.type,
+        info = source.info,
+        parentfolder = folder.id
+      )
+      newfile.hash = source.hash
+
+      # parts stay in the channel of the original file
+      dbFile = create_file(newfile, folder.id, session= session)
+
+    Log.info(f"'{filename}' has the same content of '{source.filename}' [{source.id}], its parts are reused: [{dbFile.id}]")
+    return dbFile
+
   async def delete(self, path, simulate= False):
 
     paths = self.split_path(path)
@@ -636,6 +754,10 @@ class FSApi():
         client = TGClients.next_client()
 
         for part in parts:
+          if count_message_references(part.messageid, data.channel, data.id, session= session) > 0:
+            Log.info(f"message {part.messageid} of '{data.filename}' is used by other files, keep it")
+            continue
+
           mess = await client.get_message(data.channel, part.messageid)
           if ( mess and mess.media ):
             media = TelegramApi.get_media_from_message(mess)
@@ -691,7 +813,9 @@ class FSApi():
 
           # delete old art
           if has_part:
-            if delete_original:
+            if delete_original and count_message_references(part.messageid, source_ch, dbFile.id) > 0:
+              Log.info(f"message {part.messageid} of '{dbFile.filename}' is used by other files, keep it")
+            elif delete_original:
               resp = await client.delete_message(source_ch, part.messageid)
               if resp.pts_count != 1:
                 raise Exception(f"More than one message has been deleted")
@@ -781,6 +905,10 @@ class FSApi():
             channel = dest_channel,
             state = item.state
           )
+          # content is copied as it is stored
+          new_file.content_codec = item.content_codec
+          new_file.content_original_size = item.content_original_size
+          new_file.hash = item.hash
 
           # we are coping file: create a new file
           create_file( new_file, dest_folder.id, session= session )
@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import os
+import threading
+
+# bytes read at once when hashing a local file
+READ_CHUNK = 4 * 1024 * 1024
+
+
+def get_content_hash(content: bytes):
+  return hashlib.sha256(content).hexdigest()
+
+
+class StreamHasher():
+  """
+  computes the SHA-256 of a stream and of its portions, out of the event loop.
+  Chunks are hashed by a single thread, in the order they are given
+  """
+
+  def __init__(self):
+    self.executor = ThreadPoolExecutor(max_workers= 1, thread_name_prefix= 'hasher')
+    self.file = hashlib.sha256()
+    self.portion = hashlib.sha256()
+
+  def update(self, data: bytes):
+    self.executor.submit(self._update, data)
+
+  def _update(self, data: bytes):
+    self.file.update(data)
+    self.portion.update(data)
+
+  def _end_portion(self):
+    digest = self.portion.hexdigest()
+    self.portion = hashlib.sha256()
+    return digest
+
+  async def end_portion(self):
+    """
+    returns the digest of the chunks given since the previous portion
+    """
+    return await asyncio.wrap_future( self.executor.submit(self._end_portion) )
+
+  async def end(self):
+    digest = await asyncio.wrap_future( self.executor.submit(self.file.hexdigest) )
+    self.close()
+    return digest
+
+  def close(self):
+    self.executor.shutdown(wait= False, cancel_futures= True)
+
+
+def hash_file(fd: int, offset: int, size: int, portion_size: int, stopping: threading.Event | None = None):
+  """
+  reads `size` bytes of a local file from `offset`, returning the digest of all of them
+  and the digests of each `portion_size` bytes. Blocking: run it in a thread
+  """
+  file = hashlib.sha256()
+  portion = hashlib.sha256()
+  portions = []
+
+  position = 0
+  while position < size:
+    if stopping is not None and stopping.is_set():
+      raise Exception('hashing has been stopped')
+
+    length = min(READ_CHUNK, size - position, portion_size - position % portion_size)
+    data = os.pread(fd, length, offset + position)
+    if not data:
+      raise Exception(f"file is shorter than expected: {position} of {size} bytes")
+
+    file.update(data)
+    portion.update(data)
+    position += len(data)
+
+    if position % portion_size == 0 or position == size:
+      portions.append( portion.hexdigest() )
+      portion = hashlib.sha256()
+
+  return file.hexdigest(), portions
+
+
+def get_file_hash(path: str):
+  """
+  returns the digest of a local file. Blocking: run it in a thread
+  """
+  with open(path, 'rb') as f:
+    size = os.fstat( f.fileno() ).st_size
+    digest, _ = hash_file(f.fileno(), 0, size, max(size, 1))
+  return digest
@@ -0,0 +1,281 @@
+from services.database import TGFile, count_file_access, get_pins, update_pin
+from services.downloader import Downloader, CHUNK
+from services.tgclients import TGClients
+from configuration import Config
+from collections import OrderedDict
+import asyncio
+import datetime
+import os
+import logging
+
+Log = logging.getLogger('Pins')
+
+
+class PinEntry():
+
+  size = 0
+  tag = None
+  manual = False
+  hits = 0
+
+  def __init__(self, size: int, tag: str, manual: bool, hits: int):
+    self.size = size
+    self.tag = tag
+    self.manual = manual
+    self.hits = hits
+
+
+class FileDestination():
+  """
+  Downloader destination which writes into a local file
+  """
+
+  def __init__(self, file):
+    self.file = file
+
+  async def write(self, data):
+    await asyncio.to_thread(self.file.write, data)
+
+  async def write_eof(self):
+    pass
+
+
+class PinStore():
+
+  folder = None
+  max_size = 0
+  # bytes of pinned files and of files being pinned
+  current_size = 0
+
+  # item id -> PinEntry, least recently served first
+  entries = None
+  # item id -> download task
+  downloading = None
+
+  def __init__(self, folder: str, max_size: int):
+    self.folder = folder
+    self.max_size = max_size
+    self.current_size = 0
+    self.entries = OrderedDict()
+    self.downloading = {}
+
+
+  def load(self):
+    if not os.path.exists(self.folder):
+      os.makedirs(self.folder)
+
+    records = sorted( get_pins(), key= lambda r: r.get('last_access') or datetime.datetime.min )
+    for record in records:
+      id = record['_id']
+      if record.get('state') != 'PINNED':
+        if record.get('state') is not None:
+          # interrupted download
+          update_pin(id, state= None)
+        continue
+
+      path = self.get_path(id)
+      if not os.path.exists(path) or os.path.getsize(path) != record['size']:
+        Log.warning(f"pinned file of {id} is missing or incomplete")
+        update_pin(id, state= None)
+        continue
+
+      self.entries[id] = PinEntry(record['size'], record['tag'], record.get('manual', False), record.get('hits', 0))
+      self.current_size += record['size']
+
+    # leftovers of interrupted downloads or of files unpinned while offline
+    for file in os.scandir(self.folder):
+      if file.name not in self.entries:
+        os.remove(file.path)
+
+    Log.info(f"pinned files in '{self.folder}': {len(self.entries)} files, {self.current_size} of {self.max_size} bytes")
+
+
+  def get_path(self, id):
+    return os.path.join(self.folder, str(id))
+
+
+  def get_pinned_path(self, item: TGFile):
+    entry = self.entries.get(item.id, None)
+    if entry is None:
+      return None
+
+    if entry.tag != item.content_tag():
+      Log.info(f"content of '{item.filename}' has changed, unpin it")
+      self.unpin(item.id, reset= False)
+      return None
+
+    self.entries.move_to_end(item.id)
+    return self.get_path(item.id)
+
+
+  def on_access(self, item: TGFile, size: int):
+    record = count_file_access(item.id)
+
+    entry = self.entries.get(item.id, None)
+    if entry is not None:
+      entry.hits = record['hits']
+      return
+
+    if Config.cache.pin.hits > 0 and record['hits'] >= Config.cache.pin.hits and item.parts:
+      self.pin(item, size, manual= False, hits= record['hits'])
+
+
+  def pin(self, item: TGFile, size: int, manual = True, hits = 0):
+    if size > self.max_size:
+      raise Exception(f"'{item.filename}' is larger than pin capacity: {size} > {self.max_size}")
+
+    entry = self.entries.get(item.id, None)
+    if entry is not None:
+      if manual and not entry.manual:
+        entry.manual = True
+        update_pin(item.id, manual= True)
+      return
+
+    if item.id in self.downloading:
+      return
+
+    if not self.make_room(size, manual, hits):
+      if manual:
+        raise Exception(f"no room for '{item.filename}': {self.current_size} of {self.max_size} bytes are pinned on request")
+      Log.debug(f"no room for '{item.filename}', pinned files are hotter")
+      return
+
+    self.current_size += size
+    task = asyncio.ensure_future( self.download(item, size, manual, hits) )
+    self.downloading[item.id] = task
+    task.add_done_callback(lambda _: self.downloading.pop(item.id, None))
+
+
+  def make_room(self, size: int, manual: bool, hits: int):
+    """
+    evicts automatic pins, least recently served first, until `size` bytes are available.
+    Automatic pins evict only colder files, pins on request are never evicted
+    """
+    candidates = [ id for id, entry in self.entries.items() if not entry.manual and (manual or entry.hits < hits) ]
+
+    available = self.max_size - self.current_size
+    needed = []
+    for id in candidates:
+      if available >= size:
+        break
+      available += self.entries[id].size
+      needed.append(id)
+
+    if available < size:
+      return False
+
+    for id in needed:
+      Log.info(f"evict pinned file {id}")
+      self.unpin(id, reset= False)
+
+    return True
+
+
+  async def download(self, item: TGFile, size: int, manual: bool, hits: int):
+    path = self.get_path(item.id)
+    temp_path = f"{path}.tmp"
+    tag = item.content_tag()
+
+    update_pin(item.id, state= 'DOWNLOADING', manual= manual, size= size, tag= tag)
+    Log.info(f"pin '{item.filename}' ({size} bytes)")
+
+    try:
+      client = TGClients.next_client(True)
+      clients = TGClients.get_download_clients(Config.telegram.download.stripe, client)
+      downloader = Downloader(client, item, 0, size - 1, clients)
+
+      with open(temp_path, 'wb') as f:
+        await downloader.execute( FileDestination(f) )
+
+      if os.path.getsize(temp_path) != size:
+        raise Exception(f"downloaded {os.path.getsize(temp_path)} of {size} bytes")
+
+      os.replace(temp_path, path)
+
+    except BaseException as e:
+      Log.error(f"cannot pin '{item.filename}': {e}")
+      self.current_size -= size
+      update_pin(item.id, state= None)
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      if isinstance(e, asyncio.CancelledError):
+        raise
+      return
+
+    self.entries[item.id] = PinEntry(size, tag, manual, hits)
+    update_pin(item.id, state= 'PINNED')
+    Log.info(f"'{item.filename}' is pinned")
+
+
+  def unpin(self, id, reset = True):
+    task = self.downloading.get(id, None)
+    if task is not None:
+      task.cancel()
+
+    entry = self.entries.pop(id, None)
+    if entry is not None:
+      self.current_size -= entry.size
+      try:
+        os.remove(self.get_path(id))
+      except OSError as e:
+        Log.warning(f"cannot remove pinned file of {id}: {e}")
+
+    if reset:
+      # start counting again, otherwise next access would pin it again
+      update_pin(id, state= None, manual= False, hits= 0)
+    else:
+      update_pin(id, state= None)
+
+
+  def get_pinned_files(self):
+    items = []
+    for id, entry in self.entries.items():
+      items.append({ 'id': id, 'size': entry.size, 'manual': entry.manual, 'hits': entry.hits, 'state': 'PINNED' })
+    for id in self.downloading:
+      items.append({ 'id': id, 'state': 'DOWNLOADING' })
+    return items
+
+
+async def send_file_range(request, stream, path: str, start: int, end: int):
+  """
+  sends bytes [start, end] of a local file to `stream`, which has been prepared on `request`,
+  using the kernel sendfile when the transport supports it
+  """
+  count = (end - start) + 1
+  transport = request.transport
+  if transport is None:
+    raise ConnectionResetError('Connection lost')
+
+  with open(path, 'rb') as f:
+    if not stream.compression and transport.get_extra_info('sslcontext') is None:
+      # headers are kept by aiohttp until the first write: send them before the file
+      await stream.write(b'')
+      try:
+        await asyncio.get_running_loop().sendfile(transport, f, start, count)
+        return
+      except NotImplementedError:
+        # uvloop has no sendfile
+        pass
+
+    f.seek(start)
+    while count > 0:
+      data = await asyncio.to_thread(f.read, min(CHUNK, count))
+      if not data:
+        raise Exception(f"pinned file '{path}' is shorter than expected")
+      await stream.write(data)
+      count -= len(data)
+
+
+PinnedFiles: PinStore | None = None
+
+def init_pins():
+  global PinnedFiles
+
+  if Config.cache.pin.size > 0:
+    PinnedFiles = PinStore(
+      os.path.join(Config.data, Config.cache.pin.folder),
+      Config.cache.pin.size
+    )
+    PinnedFiles.load()
+  else:
+    Log.info('file pinning is disabled')
@@ -0,0 +1,106 @@
+from services.downloader import Downloader, CHUNK
+from services import chunkcache
+from configuration import Config
+import asyncio
+import logging
+import time
+
+Log = logging.getLogger('Playback')
+
+
+class PlaybackSession():
+
+  key = None
+  # end (exclusive) of the last range requested
+  position = 0
+  # end (exclusive) of the bytes read ahead
+  prefetched = 0
+  last_access = 0
+  readahead = None
+
+  def __init__(self, key):
+    self.key = key
+    self.position = 0
+    self.prefetched = 0
+    self.last_access = time.monotonic()
+    self.readahead = None
+
+
+  def is_sequential(self, start):
+    # players may re-request the tail of the previous range, or skip what has been read ahead
+    return self.position - CHUNK <= start <= max(self.position, self.prefetched) + CHUNK
+
+
+  def is_reading_ahead(self):
+    return self.readahead is not None and not self.readahead.done()
+
+
+  def cancel(self):
+    if self.is_reading_ahead():
+      self.readahead.cancel()
+    self.readahead = None
+    self.prefetched = 0
+
+
+# (remote address, user agent, file id) -> playback session
+Sessions: dict[tuple, PlaybackSession] = {}
+
+
+def evict_idle_sessions():
+  now = time.monotonic()
+  for key, session in list(Sessions.items()):
+    if now - session.last_access > Config.cache.readahead.idle:
+      Log.debug(f"playback session {key} is idle, forget it")
+      session.cancel()
+      del Sessions[key]
+
+
+def on_range_request(key, service: Downloader):
+  """
+  tracks the ranges requested by a player and reads ahead the next ones when they are sequential
+  """
+  if Config.cache.readahead.size <= 0 or chunkcache.MemoryCache is None or service.parts is None:
+    return
+
+  evict_idle_sessions()
+
+  start = service.range_start
+  end = service.range_end + 1
+
+  session = Sessions.get(key, None)
+  sequential = session is not None and session.is_sequential(start)
+  if session is None:
+    session = PlaybackSession(key)
+    Sessions[key] = session
+
+  session.position = end
+  session.last_access = time.monotonic()
+
+  if not sequential:
+    # first request or seek: the window read ahead is useless
+    session.cancel()
+    return
+
+  target = min(end + Config.cache.readahead.size, service.totalsize)
+  if target <= session.prefetched or session.is_reading_ahead():
+    return
+
+  begin = max(end, session.prefetched)
+  if begin >= target:
+    return
+
+  Log.debug(f"read ahead {begin}-{target} of '{service.file.filename}' for {key}")
+
+  session.prefetched = target
+  downloader = Downloader(service.client, service.file, begin, target - 1, service.clients)
+  session.readahead = asyncio.ensure_future( read_ahead(downloader) )
+
+
+async def read_ahead(downloader: Downloader):
+  try:
+    await downloader.prefetch()
+  except asyncio.CancelledError:
+    downloader.stop()
+    raise
+  except Exception as e:
+    Log.debug(f"cannot read ahead '{downloader.file.filename}': {e}")
@@ -7,9 +7,11 @@ from telethon import TelegramClient
 from utils import tele_to_pyro_me
 from configuration import Config
 from constants import UPLOAD_CHUNK
+import asyncio
 import random
 import logging
 import string
+import time
 
 Log = logging.getLogger("TGApi")
 
@@ -21,12 +23,22 @@ except:
   Log.info("no uvloop found")
 
 
+class FileLocation():
+  def __init__(self, media_id = 0, access_hash = 0, file_reference = b'', dc_id = None):
+    self.media_id = media_id
+    self.access_hash = access_hash
+    self.file_reference = file_reference
+    self.dc_id = dc_id
+
+
 class TelegramApi:
 
   is_bot = False
   username = None
   is_premium = False
   max_upload_parts = 0
+  # monotonic time until telegram asked to wait (FLOOD_WAIT)
+  flood_until = 0
 
   def __init__(self, name, api_id, api_hash, bot_token = None, session = None):
     self._name = name
@@ -37,6 +49,15 @@ class TelegramApi:
 
     self.session = session
 
+    # (channel_id, message_id) -> (expire time, FileLocation)
+    self.locations = {}
+
+    # dc -> media sessions used round-robin for downloads
+    self.media_pools = {}
+    self.media_pool_index = {}
+    self.media_locks = {}
+    self.background_tasks = set()
+
 
 
   async def start(self):
@@ -156,65 +177,165 @@ class TelegramApi:
     return message
 
 
-  async def get_media_session(self, dc):
-    ms = self.api.media_sessions.get(dc, None)
-
-    if ms is None:
-      if dc != await self.api.storage.dc_id():
-        Log.debug(f"creating and switch new media_session for {dc}")
-        ms = Session(
-          self.api,
-          dc,
-          await Auth(
-              self.api, dc, await self.api.storage.test_mode()
-          ).create(),
-          await self.api.storage.test_mode(),
-          is_media=True,
-        )
-        await ms.start()
+  async def get_file_location(self, channel_id, mesgId: int, expired: FileLocation = None, known: FileLocation = None):
+    key = (int(channel_id), int(mesgId))
+    now = time.monotonic()
+
+    cached = self.locations.get(key, None)
+    if cached is not None and cached[0] > now:
+      location = cached[1]
+      # another request may have already refreshed the expired reference
+      if expired is None or location.file_reference != expired.file_reference:
+        return location
+
+    if known is not None and (expired is None or known.file_reference != expired.file_reference):
+      # location stored in DB, it will be refreshed as soon as it expires
+      self.locations[key] = (now + Config.telegram.download.location_ttl, known)
+      return known
+
+    Log.debug(f"resolving location of message {mesgId} in chat {channel_id}")
+    message = await self.get_message(channel_id, mesgId)
+    if message is None:
+      self.locations.pop(key, None)
+      raise Exception(f"no message found with id '{mesgId}' in chat '{channel_id}'")
+
+    media = TelegramApi.get_media_from_message( message )
+    if media is None:
+      raise Exception(f"message '{mesgId}' in chat '{channel_id}' has no media")
+
+    location = FileLocation(
+      media_id = media.filedata.media_id,
+      access_hash = media.filedata.access_hash,
+      file_reference = media.filedata.file_reference,
+      dc_id = media.filedata.dc_id
+    )
 
-        for _ in range(6):
-          exported_auth = await self.api.invoke(
-            raw.functions.auth.ExportAuthorization(dc_id=dc)
-          )
+    if len(self.locations) > 10000:
+      # drop expired locations
+      self.locations = { k: v for k, v in self.locations.items() if v[0] > now }
+
+    self.locations[key] = (now + Config.telegram.download.location_ttl, location)
+    return location
+
+
+  async def create_media_session(self, dc):
+    if dc != await self.api.storage.dc_id():
+      Log.debug(f"creating and switch new media_session for {dc}")
+      ms = Session(
+        self.api,
+        dc,
+        await Auth(
+            self.api, dc, await self.api.storage.test_mode()
+        ).create(),
+        await self.api.storage.test_mode(),
+        is_media=True,
+      )
+      await ms.start()
 
-          try:
-            await ms.invoke(
-              raw.functions.auth.ImportAuthorization(
-                id=exported_auth.id, bytes=exported_auth.bytes
-              )
-            )
-            break
-          except AuthBytesInvalid:
-            Log.debug(
-              f"Invalid authorization bytes for DC {dc}"
+      for _ in range(6):
+        exported_auth = await self.api.invoke(
+          raw.functions.auth.ExportAuthorization(dc_id=dc)
+        )
+
+        try:
+          await ms.invoke(
+            raw.functions.auth.ImportAuthorization(
+              id=exported_auth.id, bytes=exported_auth.bytes
             )
-            continue
-        else:
-          await ms.stop()
-          raise AuthBytesInvalid
+          )
+          break
+        except AuthBytesInvalid:
+          Log.debug(
+            f"Invalid authorization bytes for DC {dc}"
+          )
+          continue
       else:
-        Log.debug(f"creating a new media_session for {dc}")
-        ms = Session(
-          self.api,
-          dc,
-          await self.api.storage.auth_key(),
-          await self.api.storage.test_mode(),
-          is_media=True,
-        )
-        await ms.start()
-      # Log.debug(f"Created media session for DC {dc}")
-      self.api.media_sessions[dc] = ms
+        await ms.stop()
+        raise AuthBytesInvalid
+    else:
+      Log.debug(f"creating a new media_session for {dc}")
+      ms = Session(
+        self.api,
+        dc,
+        await self.api.storage.auth_key(),
+        await self.api.storage.test_mode(),
+        is_media=True,
+      )
+      await ms.start()
     
     return ms
 
 
-  async def get_file(self, id, hash, reference, offset = 0, dc = None, limit = UPLOAD_CHUNK * 2):
+  async def fill_media_pool(self, dc, size = None):
+    pool = self.media_pools.setdefault(dc, [])
+    lock = self.media_locks.setdefault(dc, asyncio.Lock())
+    size = size or Config.telegram.download.sessions
+
+    async with lock:
+      while len(pool) < size:
+        ms = await self.create_media_session(dc)
+        pool.append(ms)
+        Log.debug(f"media_session pool for {dc}: {len(pool)}/{Config.telegram.download.sessions}")
+
+      # pyrogram uses its own media_sessions, share the first one
+      if len(pool) > 0:
+        self.api.media_sessions[dc] = pool[0]
+
+
+  async def get_media_session(self, dc):
+    pool = self.media_pools.get(dc, None)
+
+    if not pool:
+      # first request for this DC: wait for a single session
+      await self.fill_media_pool(dc, 1)
+      pool = self.media_pools[dc]
+
+    if len(pool) < Config.telegram.download.sessions and not self.media_locks[dc].locked():
+      # use the available sessions while the pool is filled
+      task = asyncio.ensure_future( self.fill_media_pool(dc) )
+      self.background_tasks.add(task)
+      task.add_done_callback(self.background_tasks.discard)
+
+    index = (self.media_pool_index.get(dc, -1) + 1) % len(pool)
+    self.media_pool_index[dc] = index
+    return pool[index]
+
+
+  async def warmup_media_sessions(self, dcs):
+    Log.info(f"warming up {Config.telegram.download.sessions} media_sessions for DCs {dcs} of {self.username}")
+    results = await asyncio.gather(*[ self.fill_media_pool(dc) for dc in dcs ], return_exceptions= True)
+    for dc, result in zip(dcs, results):
+      if isinstance(result, Exception):
+        Log.warning(f"cannot warm up media_sessions for {dc}: {result}")
+
+
+  async def reset_media_session(self, dc, ms = None):
+    pool = self.media_pools.get(dc, [])
+    sessions = [ ms ] if ms is not None else list(pool)
+
+    for session in sessions:
+      if session in pool:
+        pool.remove(session)
+      if self.api.media_sessions.get(dc, None) is session:
+        self.api.media_sessions.pop(dc, None)
+        if len(pool) > 0:
+          self.api.media_sessions[dc] = pool[0]
+
+      Log.debug(f"reset media_session for {dc}")
+      try:
+        await session.stop()
+      except Exception as e:
+        Log.warning(f"cannot stop media_session for {dc}: {e}")
+
+
+  async def get_file(self, id, hash, reference, offset = 0, dc = None, limit = UPLOAD_CHUNK * 2, precise = False):
 
     _api = self.api
+    ms = None
 
     if dc is not None:
-      _api = await self.get_media_session(dc)
+      ms = await self.get_media_session(dc)
+      _api = ms
 
     location = raw.types.InputDocumentFileLocation(
       id=id,
@@ -227,9 +348,16 @@ class TelegramApi:
       location = location,
       offset = offset,
       limit = limit,
-      precise = False
+      precise = precise
     )
-    return await _api.invoke(file_call)
+
+    try:
+      return await _api.invoke(file_call)
+    except (OSError, asyncio.TimeoutError) as e:
+      if ms is not None:
+        # the media session may be broken, it will be re-created
+        await self.reset_media_session(dc, ms)
+      raise e
   
   async def send_file_parts(self, id, num_part, total_parts, file_bytes):
     file = raw.functions.upload.SaveBigFilePart(
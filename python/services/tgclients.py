@@ -61,3 +61,34 @@ class TGClients():
     Log.info(f"using client: {client.username} (Bot: {client.is_bot} for download: {download})")
     
     return client
+
+  @staticmethod
+  def get_user_client(username: str):
+    for client in UserClients:
+      if client.username == username:
+        return client
+    return None
+
+  @staticmethod
+  def get_download_clients(count: int, first: TelegramApi = None):
+    clients = [ first ] if first is not None else []
+
+    for client in BotClients + UserClients:
+      if len(clients) >= count:
+        break
+      if client not in clients:
+        clients.append(client)
+
+    return clients
+
+  @staticmethod
+  def get_upload_clients(count: int, first: TelegramApi = None, preferred: list[TelegramApi] | None = None):
+    clients = [ first ] if first is not None else []
+
+    for client in (preferred or []) + UserClients:
+      if len(clients) >= count:
+        break
+      if client not in clients:
+        clients.append(client)
+
+    return clients
@@ -1,9 +1,15 @@
+import asyncio
+import datetime
+import io
 import logging
 from configuration import Config
 from constants import UPLOAD_CHUNK
+from .hashing import StreamHasher, hash_file
 from .telegram import TelegramApi
 import mimetypes
 import math
+import os
+import threading
 import traceback
 from utils import EventEmitter
 
@@ -12,8 +18,11 @@ Log = logging.getLogger('Uploader')
 PART_TO_LOG_DEBUG = 100 * 1024 * 1024
 PART_TO_LOG_INFO = 500 * 1024 * 1024
 
+# acknowledged parts between two checkpoints of a portion (8MB)
+CHECKPOINT_PARTS = 16
+
 class Portion():
-  def __init__(self, index = -1, file_id = None, current_part = -1, mime = 'application/octet-stream', filename = '', msg_id = 0, size = 0, content = None, ):
+  def __init__(self, index = -1, file_id = None, current_part = -1, mime = 'application/octet-stream', filename = '', msg_id = 0, size = 0, content = None, access_hash = None, dc_id = None, file_reference = None, hash = None, offset = 0):
     self.index = index
     self.file_id = file_id
     self.current_part = current_part
@@ -22,6 +31,197 @@ class Portion():
     self.msg_id = msg_id
     self.size = size
     self.content = content
+    self.access_hash = access_hash
+    self.dc_id = dc_id
+    self.file_reference = file_reference
+    # SHA-256 of the portion content
+    self.hash = hash
+    # position inside a document shared with other small files
+    self.offset = offset
+
+
+class StreamSource():
+  """
+  source of Uploader reading an aiohttp body part while it is received
+  """
+
+  def __init__(self, part):
+    self.part = part
+
+  async def read(self, size: int):
+    # a short read means end of stream for Uploader
+    data = bytearray()
+    while len(data) < size:
+      chunk = await self.part.read_chunk( size - len(data) )
+      if not chunk:
+        break
+      data += chunk
+    return data
+
+
+class PortionSource():
+  """
+  source of Uploader reading a range of a local file, independently from the other ranges
+  """
+
+  def __init__(self, fd: int, offset: int, size: int):
+    self.fd = fd
+    self.position = offset
+    self.end = offset + size
+
+  async def read(self, size: int):
+    size = min(size, self.end - self.position)
+    if size <= 0:
+      return b''
+    data = await asyncio.to_thread(os.pread, self.fd, size, self.position)
+    self.position += len(data)
+    return data
+
+
+def get_source_size(source):
+  """
+  returns bytes left in a local file, None for streams
+  """
+  try:
+    if not source.seekable():
+      return None
+    return os.fstat( source.fileno() ).st_size - source.tell()
+  except (AttributeError, OSError, ValueError):
+    return None
+
+
+async def read_source(source, size: int):
+  if asyncio.iscoroutinefunction(source.read):
+    return await source.read(size)
+
+  # blocking file: read it out of the event loop
+  return await asyncio.to_thread(source.read, size)
+
+
+def is_portion_resumable(state: dict | None, clients: list[TelegramApi]):
+  if state is None or not state.get('parts') or state.get('file_id') is None:
+    return False
+
+  # uploaded parts belong to the account which sent them
+  if state.get('client') not in [ client.username for client in clients ]:
+    return False
+
+  # telegram drops uploaded parts which are not used
+  updated = state['updated'].replace(tzinfo= datetime.UTC)
+  return ( datetime.datetime.now(datetime.UTC) - updated ).total_seconds() < Config.telegram.upload.resume_ttl
+
+
+def get_moved_portion(index: int, message: dict):
+  return Portion(
+    index = index,
+    file_id = message['file_id'],
+    filename = message['filename'],
+    msg_id = message['msg_id'],
+    size = message['size'],
+    offset = message.get('offset', 0),
+    access_hash = message['access_hash'],
+    dc_id = message['dc_id'],
+    file_reference = message['file_reference']
+  )
+
+
+class Container():
+  """
+  small files of a channel waiting to be uploaded together, into the same document
+  """
+
+  def __init__(self, client: TelegramApi, channel_id):
+    self.client = client
+    self.channel_id = channel_id
+    self.data = bytearray()
+    # resolved with the portion of the uploaded document
+    self.waiting = []
+    self.timer = None
+
+
+class Packer():
+  """
+  appends small files into containers, which are uploaded when they are full
+  or after `telegram.upload.pack.linger` seconds without other files
+  """
+
+  def __init__(self):
+    # channel -> container being filled
+    self.containers = {}
+    self.uploading = set()
+
+
+  async def add(self, client: TelegramApi, channel_id, data: bytes):
+    """
+    returns the uploaded document containing `data` and the position of `data` inside it
+    """
+    loop = asyncio.get_running_loop()
+
+    # a container is a single telegram document
+    limit = min(Config.telegram.upload.pack.container, client.max_upload_parts * UPLOAD_CHUNK)
+
+    container = self.containers.get(channel_id, None)
+    if container is not None and len(container.data) + len(data) > limit:
+      self.flush(container)
+      container = None
+
+    if container is None:
+      container = Container(client, channel_id)
+      self.containers[channel_id] = container
+
+    offset = len(container.data)
+    container.data += data
+    future = loop.create_future()
+    container.waiting.append(future)
+
+    if container.timer is not None:
+      container.timer.cancel()
+
+    if len(container.data) >= limit:
+      self.flush(container)
+    else:
+      container.timer = loop.call_later(Config.telegram.upload.pack.linger, self.flush, container)
+
+    return await future, offset
+
+
+  def flush(self, container: Container):
+    if self.containers.get(container.channel_id, None) is container:
+      del self.containers[container.channel_id]
+    if container.timer is not None:
+      container.timer.cancel()
+    task = asyncio.ensure_future( self.upload(container) )
+    self.uploading.add(task)
+    task.add_done_callback(self.uploading.discard)
+
+
+  async def upload(self, container: Container):
+    filename = f"pack-{TelegramApi.generate_id()}.bin"
+    Log.info(f"upload '{filename}' with {len(container.waiting)} files ({len(container.data)} bytes) into channel {container.channel_id}")
+
+    uploader = Uploader(container.client, filename, container.channel_id)
+    uploader.min_size = 0
+    uploader.pack_size = 0
+    uploader.hash_content = False
+    portions = []
+    uploader.on('portionUploaded', lambda portion, channel_id: portions.append(portion))
+
+    try:
+      await uploader.execute( io.BytesIO(container.data) )
+      result = portions[0]
+    except Exception as e:
+      Log.error(f"cannot upload '{filename}': {e}")
+      for future in container.waiting:
+        if not future.done():
+          future.set_exception(e)
+      return
+
+    for future in container.waiting:
+      if not future.done():
+        future.set_result(result)
+
+
+Containers = Packer()
 
 
 class Uploader(EventEmitter):
@@ -33,6 +233,9 @@ class Uploader(EventEmitter):
   total_file_parts = []
 
   temp_file_bytes = None
+
+  # bytes read from source, across all portions
+  total_size = 0
   
   client = None
   
@@ -40,34 +243,73 @@ class Uploader(EventEmitter):
   
   filename = None
 
-  def __init__(self, client: TelegramApi, filename: str, channel_id: str | int = None):
+  # parts sent to telegram and not yet acknowledged
+  uploading = None
+
+  # first error of a part sent in background
+  failure = None
+
+  # SHA-256 of the whole content, once it is uploaded
+  hash = None
+
+  def __init__(self, client: TelegramApi, filename: str, channel_id: str | int = None, clients: list[TelegramApi] | None = None):
 
     # reset fields
     self.aborted = False
     self.current_file_part_index = -1
     self.total_file_parts = []
     self.temp_file_bytes = None
+    self.total_size = 0
+    self.uploading = set()
+    self.failure = None
+    self.hash = None
+    self.hasher = None
+    # SHA-256 of a local file, when the caller has already read it
+    self.source_hash = None
+    self.requests = asyncio.Semaphore( Config.telegram.upload.parallel )
 
     self.client = client
+    self.clients = clients or [ client ]
     self.channel_id = channel_id or Config.telegram.upload.channel
     self.filename = filename
 
+    # set on the uploaders of single portions of a file
+    self.first_index = 0
+    self.split = False
+    self.min_size = Config.telegram.upload.min_size
+    # files up to this size are packed into shared documents
+    self.pack_size = min(Config.telegram.upload.pack.size, Config.telegram.upload.pack.container)
+    self.children = []
+    # chunks are hashed as they are read from the source
+    self.hash_content = True
+
+    # portion index -> [contiguous acknowledged parts, parts acknowledged out of order, parts at last checkpoint]
+    self.progress = {}
+
+    # saved progress of a previous upload of the same file
+    self.checkpoint = None
+    self.saved = set()
+
 
   async def stop(self):
     self.aborted = True
+    for child in self.children:
+      child.aborted = True
     self.emit('stopped')
   
 
   def get_total_file_size(self):
-    total = 0
-    for portion in self.total_file_parts:
-      total += portion.size
-    return total
+    return self.total_size
+
+
+  def get_buffer_size(self):
+    # contents are kept into memory until they are known to be stored in DB or packed
+    return max(self.min_size, self.pack_size)
 
 
   def new_portion_file(self):
     portion = Portion(
-      index = len( self.total_file_parts ),
+      index = self.first_index + len( self.total_file_parts ),
       file_id = TelegramApi.generate_id(),
       current_part = -1,
       mime = mimetypes.guess_type(self.filename)[0] or 'application/octet-stream',
@@ -81,6 +323,73 @@ class Uploader(EventEmitter):
     return portion
 
 
+  async def send_part(self, portion: Portion, total_parts: int, data: bytes):
+    """
+    sends a part in background: it waits only when `telegram.upload.parallel` parts are already in flight
+    """
+    self.check_parts()
+    await self.requests.acquire()
+
+    part = portion.current_part
+    task = asyncio.ensure_future( self.client.send_file_parts(portion.file_id, part, total_parts, data) )
+    self.uploading.add(task)
+    task.add_done_callback(lambda task: self.on_part_sent(task, portion, part))
+
+  def on_part_sent(self, task, portion: Portion, part: int):
+    self.uploading.discard(task)
+    self.requests.release()
+
+    if task.cancelled():
+      return
+
+    if task.exception() is not None:
+      if self.failure is None:
+        self.failure = task.exception()
+    else:
+      self.on_part_acknowledged(portion, part)
+
+  async def wait_parts(self):
+    if len(self.uploading) > 0:
+      await asyncio.wait( list(self.uploading) )
+    self.check_parts()
+
+  def check_parts(self):
+    if self.failure is not None:
+      raise self.failure
+
+
+  def resume(self, checkpoint: dict, saved: list[int]):
+    """
+    continues an upload interrupted with `checkpoint`, whose portions with index in `saved` are already stored
+    """
+    self.checkpoint = checkpoint
+    self.saved = set(saved)
+
+
+  def resume_portion(self, file_id: int, parts: int, size: int):
+    """
+    continues a portion whose first `parts` parts, `size` bytes, are already acknowledged
+    """
+    portion = self.new_portion_file()
+    portion.file_id = file_id
+    portion.current_part = parts - 1
+    portion.size = size
+    self.total_size = portion.size
+    self.progress[portion.index] = [parts, set(), parts]
+
+
+  def on_part_acknowledged(self, portion: Portion, part: int):
+    progress = self.progress.setdefault(portion.index, [0, set(), 0])
+    progress[1].add(part)
+    while progress[0] in progress[1]:
+      progress[1].discard(progress[0])
+      progress[0] += 1
+
+    if progress[0] - progress[2] >= CHECKPOINT_PARTS:
+      progress[2] = progress[0]
+      self.emit('portionProgress', portion.index, portion.file_id, progress[0])
+
+
   def get_current_portion(self):
     if self.current_file_part_index > -1 and self.current_file_part_index < len( self.total_file_parts ):
       return self.total_file_parts[ self.current_file_part_index ]
@@ -89,11 +398,37 @@ class Uploader(EventEmitter):
 
   async def execute(self, source):
 
-    self.new_portion_file()
+    size = get_source_size(source)
+    if size is not None and size > self.get_buffer_size():
+      # local files are uploaded by portions, which can be resumed
+      await self.execute_portions(source, size)
+      return
+
+    if self.checkpoint is not None:
+      Log.info(f"'{self.filename}' cannot be resumed from a stream, restart it")
+      self.emit('resetUpload')
+
+    if self.get_current_portion() is None:
+      self.new_portion_file()
+
+    if self.hash_content:
+      self.hasher = StreamHasher()
+
+    try:
+      await self.execute_stream(source)
+    finally:
+      if self.hasher is not None:
+        self.hasher.close()
+
+
+  async def execute_stream(self, source):
 
     while True:
 
-      buffer = source.read( UPLOAD_CHUNK )
+      buffer = await read_source( source, UPLOAD_CHUNK )
+
+      if self.hasher is not None and len(buffer) > 0:
+        self.hasher.update(buffer)
 
       if ( len(buffer) < UPLOAD_CHUNK ):
         # stream is finish, this is the last chunk
@@ -103,11 +438,17 @@ class Uploader(EventEmitter):
         if len(buffer) > 0:
           Log.info(f"upload last chunk and then save into channel")
           await self.upload_chunk(buffer, True)
+        elif current_portion.size == 0 and len(self.total_file_parts) > 1:
+          # file size is a multiple of the portion size: previous portion was the last one
+          self.total_file_parts.pop()
+          self.current_file_part_index = len( self.total_file_parts ) - 1
         else:
           await self.send_to_channel(current_portion)
 
         if not self.aborted:
-          self.emit('completeUpload', self.total_file_parts, self.channel_id)
+          if self.hasher is not None:
+            self.hash = await self.hasher.end()
+          self.emit('completeUpload', self.total_file_parts, self.channel_id, self.hash)
         
         # loop completed
         break
@@ -119,6 +460,160 @@ class Uploader(EventEmitter):
 
 
 
+  async def execute_portions(self, source, size: int):
+    """
+    uploads the portions of a local file at the same time, each one with a different client.
+    Progress is checkpointed by portion, in order to resume the upload after a restart
+    """
+    fd = source.fileno()
+    start = source.tell()
+    mtime = os.fstat(fd).st_mtime
+    portion_size = min( c.max_upload_parts for c in self.clients ) * UPLOAD_CHUNK
+    count = math.ceil(size / portion_size)
+
+    checkpoint = self.checkpoint
+    if checkpoint is not None and (checkpoint.get('size'), checkpoint.get('mtime'), checkpoint.get('portion_size')) != (size, mtime, portion_size):
+      Log.info(f"'{self.filename}' has changed since last upload, restart it")
+      self.emit('resetUpload')
+      checkpoint = None
+      self.saved = set()
+
+    if checkpoint is None:
+      self.emit('uploadStarted', size, mtime, portion_size)
+
+    Log.info(f"upload '{self.filename}' in {count} portions with {len(self.clients)} clients")
+
+    # portions are hashed by their uploaders, the whole file is read again unless its digest is known
+    stopping = threading.Event()
+    hashing = None
+    if self.source_hash is None:
+      hashing = asyncio.ensure_future( asyncio.to_thread(hash_file, fd, start, size, size, stopping) )
+
+    async def stop_hashing():
+      stopping.set()
+      if hashing is not None:
+        await asyncio.gather(hashing, return_exceptions= True)
+
+    # clients are taken in turn, a resumed portion waits for the one which sent its parts
+    idle = list(self.clients)
+    released = asyncio.Condition()
+
+    async def acquire_client(username):
+      async with released:
+        while True:
+          for client in idle:
+            if username is None or client.username == username:
+              idle.remove(client)
+              return client
+          await released.wait()
+
+    async def release_client(client):
+      async with released:
+        idle.append(client)
+        released.notify_all()
+
+    # portions are saved in index order, whatever order they complete in
+    completed = {}
+    next_index = 0
+
+    def flush(channel_id):
+      nonlocal next_index
+      while next_index in completed or next_index in self.saved:
+        if next_index in completed:
+          portion = completed.pop(next_index)
+          self.total_file_parts.append(portion)
+          self.emit('portionUploaded', portion, channel_id)
+        next_index += 1
+
+    def on_portion_uploaded(portion, channel_id):
+      completed[portion.index] = portion
+      flush(channel_id)
+
+    async def complete_portion(portion):
+      if portion.hash is None:
+        # resumed or moved by a previous upload: its content has not been read entirely
+        offset = portion.index * portion_size
+        length = min(portion_size, size - offset)
+        portion.hash, _ = await asyncio.to_thread(hash_file, fd, start + offset, length, length)
+      on_portion_uploaded(portion, self.channel_id)
+
+    async def upload_portion(index, state):
+      resumable = is_portion_resumable(state, self.clients)
+      client = await acquire_client(state['client'] if resumable else None)
+      try:
+        if self.aborted:
+          return
+
+        uploader = Uploader(client, self.filename, self.channel_id)
+        uploader.first_index = index
+        uploader.split = count > 1
+        # every portion goes to telegram in its own document, even a small last one
+        uploader.min_size = 0
+        uploader.pack_size = 0
+
+        moved = []
+        def on_portion_moved(portion, channel_id):
+          # keep the message until the previous portions are saved
+          self.emit('portionMoved', portion)
+          moved.append(portion)
+
+        uploader.on('portionUploaded', on_portion_moved)
+        uploader.on('portionProgress', lambda index, file_id, parts: self.emit('portionProgress', index, file_id, parts, client.username))
+        self.children.append(uploader)
+
+        offset = index * portion_size
+        length = min(portion_size, size - offset)
+
+        if resumable:
+          Log.info(f"resume portion {index} of '{self.filename}' from part {state['parts']}")
+          # the last part of the file is not a full one
+          resumed = min(state['parts'] * UPLOAD_CHUNK, length)
+          uploader.resume_portion(state['file_id'], state['parts'], resumed)
+          uploader.hash_content = False
+          offset += resumed
+          length -= resumed
+
+        await uploader.execute( PortionSource(fd, start + offset, length) )
+
+      finally:
+        await release_client(client)
+
+      for portion in moved:
+        await complete_portion(portion)
+
+    portions = checkpoint.get('portions', {}) if checkpoint is not None else {}
+
+    tasks = []
+    for index in range(count):
+      state = portions.get( str(index), None )
+      if index in self.saved:
+        continue
+      if state is not None and state.get('message') is not None:
+        # moved to channel before it could be saved
+        tasks.append( asyncio.ensure_future( complete_portion( get_moved_portion(index, state['message']) ) ) )
+        continue
+      tasks.append( asyncio.ensure_future( upload_portion(index, state) ) )
+
+    # skip portions saved at the beginning of the file
+    flush(self.channel_id)
+
+    try:
+      await asyncio.gather(*tasks)
+      if self.aborted:
+        await stop_hashing()
+        return
+      self.hash = self.source_hash if hashing is None else (await hashing)[0]
+    except Exception as e:
+      for task in tasks:
+        task.cancel()
+      await stop_hashing()
+      Log.error(f"error while uploading portions of '{self.filename}': {e}")
+      self.emit('error')
+      raise e
+
+    self.emit('completeUpload', self.total_file_parts, self.channel_id, self.hash)
+
+
   async def upload_chunk(self, buffer: bytes, last_chunk = False):
     max_upload_parts = self.client.max_upload_parts
 
@@ -128,31 +623,29 @@ class Uploader(EventEmitter):
       current_portion = self.new_portion_file()
     
     current_portion.size += len(buffer)
+    self.total_size += len(buffer)
 
     send_to_channel = False
     should_upload = True
 
-    if self.get_total_file_size() > Config.telegram.upload.min_size:
+    if self.get_total_file_size() > self.get_buffer_size():
 
       if self.temp_file_bytes is not None and len(self.temp_file_bytes) > 0:
 
         # force pause stream
-        Log.debug(f"Force upload the 'in-memory buffer' because it exceeds upload.min_size: {self.get_total_file_size()}")
+        Log.debug(f"Force upload the 'in-memory buffer' because it exceeds upload.min_size or upload.pack.size: {self.get_total_file_size()}")
+
+        # slices of the buffer are sent without copying it
+        buffered = memoryview(self.temp_file_bytes)
 
-        while len(self.temp_file_bytes) > 0:
+        for position in range(0, len(buffered), UPLOAD_CHUNK):
 
-          chunk = self.temp_file_bytes[0 : UPLOAD_CHUNK]
-          self.temp_file_bytes = self.temp_file_bytes[ UPLOAD_CHUNK : ]
+          chunk = buffered[position : position + UPLOAD_CHUNK]
 
           current_portion.current_part += 1
           
           try:
-            res = await self.client.send_file_parts(
-              current_portion.file_id,
-              current_portion.current_part,
-              -1,
-              chunk
-            )
+            await self.send_part(current_portion, -1, chunk)
             # Log.debug(f"upload on telegram '{res}', part: {current_portion.current_part}, total bytes: {(current_portion.current_part + 1) * UPLOAD_CHUNK}")
             if self.get_total_file_size() % PART_TO_LOG_DEBUG == 0:
               Log.debug(f"uploaded {self.get_total_file_size()} bytes of '{self.filename}'")
@@ -168,10 +661,9 @@ class Uploader(EventEmitter):
       
     else:
       # bufefr file in-memory
-      if self.temp_file_bytes is not None:
-        self.temp_file_bytes = self.temp_file_bytes + buffer
-      else:
-        self.temp_file_bytes = buffer
+      if self.temp_file_bytes is None:
+        self.temp_file_bytes = bytearray()
+      self.temp_file_bytes += buffer
       
       should_upload = False
     
@@ -187,9 +679,8 @@ class Uploader(EventEmitter):
 
       if self.aborted is False:
         try:
-          res = await self.client.send_file_parts(
-            current_portion.file_id,
-            current_portion.current_part,
+          await self.send_part(
+            current_portion,
             math.ceil( current_portion.size / UPLOAD_CHUNK ) if send_to_channel or last_chunk else -1,
             buffer
           )
@@ -214,19 +705,29 @@ class Uploader(EventEmitter):
   async def send_to_channel(self, portion):
     filename = portion.filename
 
-    if len(self.total_file_parts) > 1:
+    if len(self.total_file_parts) > 1 or self.split:
       filename = f"{filename}.{ str( str(portion.index + 1) ).zfill(3) }"
 
     if self.aborted:
       Log.warn(f"cannot finish upload because of aborted")
       return
 
-    if self.temp_file_bytes is not None:
+    if self.temp_file_bytes is not None and len(self.temp_file_bytes) > self.min_size:
+      await self.pack_portion(portion)
+    elif self.temp_file_bytes is not None:
       # file is buffered into memory and needs to be directly inserted into db
-      portion.content = self.temp_file_bytes
+      portion.content = bytes(self.temp_file_bytes)
       Log.info('save content into DB')
     else:
 
+      try:
+        # all parts must be saved before the file is sent to channel
+        await self.wait_parts()
+      except Exception as e:
+        Log.error(f"error while upload part: {portion} - {e}")
+        self.emit('error')
+        raise e
+
       try:
 
         Log.debug(f"try to move part into channel {self.channel_id}, total parts: {math.ceil(portion.size / UPLOAD_CHUNK)} for file: '{filename}'")
@@ -243,11 +744,15 @@ class Uploader(EventEmitter):
         for update in resp.updates:
           if getattr(update, 'message', None) is not None:
             found_update = True
+            document = update.message.media.document
             portion.msg_id = update.message.id
-            portion.file_id = update.message.media.document.id
+            portion.file_id = document.id
+            portion.access_hash = document.access_hash
+            portion.dc_id = document.dc_id
+            portion.file_reference = document.file_reference
             Log.debug(f"got update for sent file: {portion.msg_id}, {portion.file_id}")
 
-            for attr in update.message.media.document.attributes:
+            for attr in document.attributes:
               if attr.QUALNAME == 'types.DocumentAttributeFilename':
                 portion.filename = attr.file_name
                 Log.debug(f"tg-filename: {portion.filename}")
@@ -262,16 +767,29 @@ class Uploader(EventEmitter):
         traceback.print_exc()
         self.emit('error')
         raise e
+
+    if self.hasher is not None:
+      portion.hash = await self.hasher.end_portion()
       
     self.emit('portionUploaded', portion, self.channel_id)
 
 
-
-
-
-
-
-
-
-
-
+  async def pack_portion(self, portion: Portion):
+    """
+    stores a small file into a document shared with other small files
+    """
+    try:
+      container, offset = await Containers.add(self.client, self.channel_id, bytes(self.temp_file_bytes))
+    except Exception as e:
+      Log.error(f"error while packing '{self.filename}': {e}")
+      self.emit('error')
+      raise e
+
+    portion.msg_id = container.msg_id
+    portion.file_id = container.file_id
+    portion.filename = container.filename
+    portion.access_hash = container.access_hash
+    portion.dc_id = container.dc_id
+    portion.file_reference = container.file_reference
+    portion.offset = offset
+    Log.info(f"'{self.filename}' has been packed into '{container.filename}' at {offset}")
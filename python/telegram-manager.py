@@ -2,7 +2,7 @@ import initialize
 import traceback
 from configuration import Config
 from constants import ROOT_ID
-from services.database import init_database, save_tg_session, get_tg_session, close_connection, addEvent
+from services.database import init_database, save_tg_session, get_tg_session, close_connection, addEvent, get_parts_dcs
 from services.tgclients import TGClients
 from services.fsapi import FSApi
 from pyrogram import idle
@@ -32,6 +32,14 @@ async def init_tg_users():
 
   TGClients.check()
 
+async def warmup_media_sessions():
+  dcs = get_parts_dcs()
+  if len(dcs) == 0:
+    return
+
+  clients = TGClients.get_all_clients()
+  await asyncio.gather(*[ client.warmup_media_sessions(dcs) for client in clients ])
+
 async def start():
   Log.info('Starting application')
 
@@ -70,6 +78,22 @@ async def start():
     deleting = Deleting()
     await deleting.delete_command(initialize.Args)
 
+  elif initialize.Args.backfill is True:
+    # enable backfill command
+    from commands.backfill import Backfill
+
+    await init_tg_users()
+
+    backfill = Backfill()
+    await backfill.backfill_command(initialize.Args)
+
+  elif initialize.Args.compress is True:
+    # enable compress command
+    from commands.compress import Compress
+
+    compress = Compress()
+    await compress.compress_command(initialize.Args)
+
   else:
 
     # start tool
@@ -78,9 +102,17 @@ async def start():
       # start http server
       Log.info('starting http server')
       from httpserver import web_server
+      from services.chunkcache import init_chunk_cache
+      from services.pins import init_pins
 
       await init_tg_users()
 
+      init_chunk_cache()
+      init_pins()
+
+      if Config.telegram.download.warmup:
+        await warmup_media_sessions()
+
       server = web.AppRunner(web_server())
       await server.setup()
       await web.TCPSite(server, Config.http.host, Config.http.port).start()
@@ -107,6 +107,7 @@ class Bot():
       client = TGClients.next_client(False)
 
       msg = await client.get_message(channel_id, message.id)
+      user_media = TelegramApi.get_media_from_message(msg)
 
       newdatafile = TGFile(
         filename = media.file_name,
@@ -116,7 +117,10 @@ class Bot():
           hash = '',
           fileid = media.filedata.media_id,
           size = media.file_size,
-          index = 0
+          index = 0,
+          access_hash = user_media.filedata.access_hash,
+          dc_id = user_media.filedata.dc_id,
+          file_reference = user_media.filedata.file_reference
         )],
         parentfolder = parentFolder,
         type = media.mime_type or mimetypes.guess_type(media.file_name)[0] or 'application/octet-stream',